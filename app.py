@@ -4,9 +4,18 @@ from flask_apispec import FlaskApiSpec
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
 from webargs.flaskparser import parser
+from werkzeug.middleware.proxy_fix import ProxyFix
 from resources import *
 from database import app, db_session, init_db, RevokedToken
 
+# Proxies in front of uwsgi whose X-Forwarded-For/-Proto to trust, so that
+# request.remote_addr is the client's address rather than the load
+# balancer's; login throttling is keyed on it. 0 when clients connect
+# directly, since they could then set the header themselves.
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', 1))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
 CORS(app)
 # Add JSON Web Token authorization
 app.config['JWT_SECRET_KEY'] = 'jwt-secret-string'
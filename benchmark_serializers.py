@@ -0,0 +1,117 @@
+"""Compare compiled serializers against marshmallow on synthetic rows.
+
+Checks that both produce the same output for TransactionSchema, ExPairSchema,
+OrderSchema and CubeSchema, then times them. Runs without a database:
+
+    python benchmark_serializers.py [rows]
+"""
+import sys
+from datetime import datetime, timedelta
+from decimal import Decimal
+from time import perf_counter
+from types import SimpleNamespace
+import simplejson
+from schemas import (CubeSchema, ExPairSchema, OrderSchema, TransactionSchema,
+                     dump)
+from serializers import (cube_serializer, dumps, ex_pair_serializer,
+                         order_serializer, transaction_serializer)
+
+
+def make_ex_pair(i):
+    return SimpleNamespace(base_symbol='B%d' % (i % 300), quote_symbol='BTC',
+                           exchange_id=i % 12)
+
+
+def make_transaction(i):
+    return SimpleNamespace(
+        datetime=datetime(2019, 1, 1) + timedelta(minutes=i),
+        base_symbol='B%d' % (i % 300), quote_symbol='BTC',
+        base_amount=Decimal('%d.123456789012' % i),
+        quote_amount=Decimal('-0.000012345678'),
+        price=Decimal('0.000000100000') if i % 7 else None,
+        type=('buy', 'sell', 'deposit', 'withdrawal')[i % 4],
+        tx_id='tx-%d' % i)
+
+
+def make_order(i):
+    created = datetime(2019, 1, 1) + timedelta(seconds=i)
+    return SimpleNamespace(
+        amount=Decimal('1.5'), avg_price=None, price=Decimal('0.0123'),
+        filled=Decimal('0.5'), unfilled=Decimal('1.0'), side='buy',
+        order_id=str(i), ex_pair=make_ex_pair(i),
+        datetime=created.strftime("%Y-%m-%d %H:%M:%S"),
+        timestamp=str(created.timestamp()))
+
+
+def make_cube(i):
+    currency = SimpleNamespace(symbol='BTC', name='Bitcoin', market_cap=10 ** 11,
+                               cmc_id='1', percent_change_24h=Decimal('1.5'),
+                               percent_change_7d=None)
+    exchange = SimpleNamespace(name='Binance', key='Key', secret='Secret',
+                               passphrase=None, video_url='', signup_url='', id=3)
+    return SimpleNamespace(
+        algorithm=SimpleNamespace(active=True, name='Tracker'),
+        api_connections=[SimpleNamespace(exchange=exchange, failed_at=None)],
+        auto_rebalance=True, balanced_at=datetime(2019, 5, 1, 12, 30),
+        btc_data=False, closed_at=None,
+        cube_cache=SimpleNamespace(processing=False), exchange=exchange,
+        fiat=currency, fiat_id=1, id=i,
+        index=SimpleNamespace(type='top_ten', count=Decimal(10),
+                              currencies=[currency] * 10),
+        is_rebalancing=False, orders=[make_order(j) for j in range(5)],
+        reallocated_at=None, rebalance_interval=2412900, risk_tolerance=1,
+        supported_assets=['BTC', 'ETH', 'LTC'], threshold=Decimal('5.00'),
+        trading_status='live', unrecognized_activity=False,
+        wide_charts=None, name='Binance')
+
+
+cases = [
+    ('TransactionSchema', TransactionSchema, transaction_serializer, make_transaction, 1),
+    ('ExPairSchema', ExPairSchema, ex_pair_serializer, make_ex_pair, 1),
+    ('OrderSchema', OrderSchema, order_serializer, make_order, 1),
+    ('CubeSchema', CubeSchema, cube_serializer, make_cube, 50),
+]
+
+
+def timed(f, *args):
+    start = perf_counter()
+    result = f(*args)
+    return result, perf_counter() - start
+
+
+def main(rows=20000):
+    for name, schema_class, compiled, make, scale in cases:
+        objs = [make(i) for i in range(max(rows // scale, 1))]
+        expected, slow = timed(dump, schema_class(many=True), objs)
+        actual, fast = timed(compiled.dump_many, objs)
+        if actual != expected:
+            raise SystemExit('%s output differs from marshmallow' % name)
+
+        expected_json, slow_json = timed(simplejson.dumps, expected)
+        actual_json, fast_json = timed(dumps, actual)
+        if simplejson.loads(actual_json, use_decimal=True) != \
+                simplejson.loads(expected_json, use_decimal=True):
+            raise SystemExit('%s JSON differs from simplejson' % name)
+
+        print('%-18s %6d rows  dump %7.1f ms -> %6.1f ms (x%.1f)  '
+              'json %6.1f ms -> %6.1f ms' % (
+                  name, len(objs), slow * 1000, fast * 1000, slow / fast,
+                  slow_json * 1000, fast_json * 1000))
+
+    rows = [(t.datetime, t.base_symbol, t.quote_symbol, t.base_amount,
+             t.quote_amount, t.price, t.type, t.tx_id)
+            for t in map(make_transaction, range(rows))]
+    columns = ('datetime', 'base_symbol', 'quote_symbol', 'base_amount',
+               'quote_amount', 'price', 'type', 'tx_id')
+    objs = [SimpleNamespace(**dict(zip(columns, row))) for row in rows]
+    ordered = [tuple(getattr(o, f) for f in transaction_serializer.field_names)
+               for o in objs]
+    expected = dump(TransactionSchema(many=True), objs)
+    actual, fast = timed(transaction_serializer.dump_rows, ordered)
+    if actual != expected:
+        raise SystemExit('TransactionSchema row output differs from marshmallow')
+    print('%-18s %6d rows  dump_rows %.1f ms' % ('Transaction tuples', len(rows), fast * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -1,8 +1,10 @@
 from datetime import datetime, time, timedelta
 import logging
+import threading
 from decimal import Decimal
 import os
 import base64
+from time import monotonic
 import pandas as pd
 import onetimepass as otp
 from sqlalchemy import *
@@ -13,7 +15,7 @@ from sqlalchemy.dialects.mysql import INTEGER as Integer
 from flask import Flask
 from sqlalchemy import exc, event, select
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import check_password_hash, generate_password_hash
+from flask_bcrypt import Bcrypt
 from flask_user import UserMixin
 
 # Define the WSGI application object
@@ -21,9 +23,12 @@ app = Flask(__name__, instance_relative_config=True)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
+# bcrypt cost of new password hashes; older hashes are upgraded on login
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
 VAULT_SEED = os.getenv('VAULT_SEED')
 
 db = SQLAlchemy(app)
+bcrypt = Bcrypt(app)
 Base = db.Model
 db_session = db.session
 engine = db.engine
@@ -57,35 +62,113 @@ def ping_connection(connection, branch):
 def init_db():
     Base.metadata.create_all(bind=engine)
 
+
+def column_query(model, names):
+    # Selects only the named attributes of a model. Rows come back as plain
+    # tuples in the order of names and never enter the session identity map.
+    return db_session.query(*[getattr(model, name) for name in names])
+
+
 # Helper functions
+class SecretCache(object):
+    # Decrypted credentials by ciphertext, kept for `ttl` seconds. Values are
+    # held as bytearrays and zeroed when they expire or are forgotten, so
+    # the plaintext does not stay in freed memory; callers still get str
+    # copies that last as long as they keep them.
+
+    def __init__(self, ttl=60, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+        self._next_sweep = 0
+
+    def get(self, ciphertext):
+        now = monotonic()
+        with self._lock:
+            self._sweep(now)
+            entry = self._data.get(ciphertext)
+            if entry is None or entry[0] < now:
+                return None
+            return entry[1].decode('utf-8')
+
+    def set(self, ciphertext, plaintext):
+        now = monotonic()
+        with self._lock:
+            self._sweep(now)
+            if len(self._data) >= self.maxsize:
+                self._wipe(next(iter(self._data)))
+            self._wipe(ciphertext)
+            self._data[ciphertext] = (now + self.ttl, bytearray(plaintext.encode('utf-8')))
+
+    def forget(self, *ciphertexts):
+        with self._lock:
+            for ciphertext in ciphertexts:
+                self._wipe(ciphertext)
+
+    def clear(self):
+        with self._lock:
+            for ciphertext in list(self._data):
+                self._wipe(ciphertext)
+
+    def _wipe(self, ciphertext):
+        entry = self._data.pop(ciphertext, None)
+        if entry is not None:
+            value = entry[1]
+            value[:] = bytes(len(value))
+
+    def _sweep(self, now):
+        # Wipes expired entries at most twice per ttl
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.ttl / 2
+        for ciphertext in [c for c, (expires_at, _) in self._data.items() if expires_at < now]:
+            self._wipe(ciphertext)
+
+
+decrypted = SecretCache(ttl=int(os.getenv('DECRYPTED_TTL', 60)))
+
+# Parsed RSA keys by seed; importing one costs more than a decryption
+_rsa_keys = {}
+
+
+def _rsa_key(seed):
+    key = _rsa_keys.get(seed)
+    if key is None:
+        from Crypto.PublicKey import RSA
+        key = _rsa_keys[seed] = RSA.importKey(base64.b64decode(seed))
+    return key
+
+
 def d(v, seed=VAULT_SEED):
     # for simplicity, returns v on failure
-    from Crypto.PublicKey import RSA
     from Crypto.Cipher import PKCS1_OAEP
-    from base64 import b64decode
+    if seed == VAULT_SEED and v:
+        plaintext = decrypted.get(v)
+        if plaintext is not None:
+            return plaintext
     try:
-        b = seed
-        k = b64decode(b)
-        r = RSA.importKey(k)
-        p = PKCS1_OAEP.new(r)
-        d = p.decrypt(b64decode(v)).decode('utf-8')
-        return d
+        p = PKCS1_OAEP.new(_rsa_key(seed))
+        plaintext = p.decrypt(base64.b64decode(v)).decode('utf-8')
     except:
         return v
+    if seed == VAULT_SEED:
+        decrypted.set(v, plaintext)
+    return plaintext
+
+
+def d_many(values, seed=VAULT_SEED):
+    # Decrypts each distinct value once; returns {value: plaintext}
+    return {v: d(v, seed) for v in set(values)}
 
 
 def e(v, seed=VAULT_SEED):
     # for simplicity, returns v on failure
-    from Crypto.PublicKey import RSA
     from Crypto.Cipher import PKCS1_OAEP
-    from base64 import b64decode, b64encode
     try:
-        b = seed
-        k = b64decode(b)
-        r = RSA.importKey(k)
-        p = PKCS1_OAEP.new(r)
+        p = PKCS1_OAEP.new(_rsa_key(seed))
         e = p.encrypt(v.encode('utf-8'))
-        be = b64encode(e).decode('utf-8')
+        be = base64.b64encode(e).decode('utf-8')
         return be
     except:
         raise
@@ -238,6 +321,19 @@ class Connection(Mixin, Base):
         p = d(self.passphrase)
         return exapi.exs[self.exchange.name](k, s, p)
 
+    def forget_decrypted(self):
+        # Wipes the cached plaintext; call before the keys change or go
+        decrypted.forget(self.key, self.secret, self.passphrase)
+
+    @staticmethod
+    def decrypt_all(connections):
+        # {connection id: (key, secret, passphrase)} for several connections,
+        # decrypting each distinct ciphertext once
+        connections = list(connections)
+        plain = d_many(v for c in connections for v in (c.key, c.secret, c.passphrase))
+        return {c.id: (plain[c.key], plain[c.secret], plain[c.passphrase])
+                for c in connections}
+
     def __repr__(self):
         return '<Connection(id={s.id}, cube_id={s.cube_id}, exchange_id={s.exchange_id}, ' \
                'exchange={s.exchange}, failed_at={s.failed_at})>'.format(s=self)
@@ -873,10 +969,21 @@ class User(Mixin, Base, UserMixin):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = bcrypt.generate_password_hash(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return bcrypt.check_password_hash(self.password_hash, password)
+
+    @property
+    def password_needs_rehash(self):
+        # Hashes look like $2b$12$..., the second field being the cost
+        password_hash = self.password_hash
+        if isinstance(password_hash, bytes):
+            password_hash = password_hash.decode('utf-8')
+        try:
+            return int(password_hash.split('$')[2]) != app.config['BCRYPT_LOG_ROUNDS']
+        except (AttributeError, IndexError, ValueError):
+            return False
 
     def set_totp_secret(self):
         self.otp_secret = base64.b32encode(os.urandom(10)).decode('utf-8')
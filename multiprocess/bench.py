@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+from time import sleep, time
+import main
+from sinks import EXTENSIONS, FORMATS, open_sink
+
+
+# Runs a full crawl against a local replay server and reports what each
+# stage did, so pipeline changes can be compared on equal terms:
+#
+#   python bench.py --letters 6 --latency 0.02 --workers 4
+#   python bench.py --json before.json ...   then compare with after.json
+#
+# Parse runs in the pool processes, fetch and write in this one. The replay
+# server's own usage is left out of the numbers.
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_replay(args, port):
+    command = [sys.executable, 'replay.py', '--port', str(port),
+               '--pages-per-letter', str(args.pages_per_letter),
+               '--profiles-per-page', str(args.profiles_per_page),
+               '--latency', str(args.latency), '--jitter', str(args.jitter),
+               '--error-rate', str(args.error_rate),
+               '--max-concurrency', str(args.max_concurrency)]
+    if args.pages:
+        command += ['--pages', args.pages]
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return server
+        except OSError:
+            sleep(0.1)
+    server.kill()
+    raise SystemExit('Replay server did not start')
+
+
+def run(args, base_url, output):
+    sink = open_sink(output, args.format)
+    before = os.times()
+    start = time()
+    frontier, metrics = asyncio.run(main.main1(sink, args.workers, args.fetch_concurrency,
+                                               args.batch_size, rate=args.rate,
+                                               letters=main.LETTERS[:args.letters],
+                                               base_url=base_url))
+    sink.close()
+    wall = time() - start
+    after = os.times()
+
+    # The pool's processes have been joined by now, so they are counted in
+    # the children figures; the replay server is still running and is not
+    main_cpu = (after.user - before.user) + (after.system - before.system)
+    pool_cpu = (after.children_user - before.children_user) + \
+        (after.children_system - before.children_system)
+    return {
+        'wall_seconds': round(wall, 3),
+        'workers': args.workers,
+        'cpus': os.cpu_count(),
+        'profiles': frontier.enqueued,
+        'records': sink.written,
+        'profiles_per_second': round(sink.written / wall, 1),
+        'stages': {stage: s.summary() for stage, s in metrics.stages.items()},
+        'histograms': {name: h.summary() for name, h in metrics.histograms.items()},
+        'failures': dict(metrics.failures),
+        'cpu': {
+            'main_seconds': round(main_cpu, 3),
+            'main_utilization': round(main_cpu / wall, 3),
+            'pool_seconds': round(pool_cpu, 3),
+            'pool_utilization': round(pool_cpu / wall / args.workers, 3),
+        },
+        # ru_maxrss is in KiB on Linux; children is the largest pool process
+        'peak_rss_mib': {
+            'main': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'pool_process': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        },
+    }
+
+
+def report(result):
+    print('%(records)s records in %(wall_seconds)ss, %(profiles_per_second)s/s' % result)
+    print('%-8s %8s %10s %10s %12s' % ('stage', 'items', 'seconds', 'per sec', 'mean latency'))
+    for stage, s in result['stages'].items():
+        print('%-8s %8s %10s %10s %12s' % (stage, s['items'], s['seconds'], s['per_second'],
+                                           s['mean_latency']))
+    for name, h in sorted(result['histograms'].items()):
+        print('%-16s p50 %.4fs  p90 %.4fs  p99 %.4fs  max %.4fs'
+              % (name, h['p50'], h['p90'], h['p99'], h['max']))
+    if result['failures']:
+        print('failures %s' % result['failures'])
+    cpu, rss = result['cpu'], result['peak_rss_mib']
+    print('cpu      main %ss (%.0f%% of one core), pool %ss (%.0f%% of %s workers), %s cpus'
+          % (cpu['main_seconds'], cpu['main_utilization'] * 100, cpu['pool_seconds'],
+             cpu['pool_utilization'] * 100, result['workers'], result['cpus']))
+    print('peak rss main %s MiB, largest pool process %s MiB' % (rss['main'], rss['pool_process']))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the scraper against a local replay server.')
+    parser.add_argument('--letters', type=int, default=len(main.LETTERS), help='letters to crawl')
+    parser.add_argument('--pages', help='directory of recorded pages (default: synthetic)')
+    parser.add_argument('--pages-per-letter', type=int, default=5)
+    parser.add_argument('--profiles-per-page', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--max-concurrency', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=main.WORKERS)
+    parser.add_argument('--fetch-concurrency', type=int, default=main.FETCH_CONCURRENCY)
+    parser.add_argument('--rate', type=float, default=1000)
+    parser.add_argument('--batch-size', type=int, default=main.BATCH_SIZE)
+    parser.add_argument('--format', choices=FORMATS, default='tsv')
+    parser.add_argument('--json', help='also write the results to this file')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    logging.getLogger('main').setLevel(logging.WARNING)
+    logging.getLogger('parse_funcs').setLevel(logging.WARNING)
+
+    port = free_port()
+    server = start_replay(args, port)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            result = run(args, 'http://127.0.0.1:%s' % port,
+                         os.path.join(tmp, 'data.' + EXTENSIONS[args.format]))
+    finally:
+        server.terminate()
+        server.wait()
+
+    report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,157 @@
+import argparse
+import glob
+import os
+from time import perf_counter
+from bs4 import BeautifulSoup
+import parse_funcs
+from samples import listing_page, profile_bytes
+
+
+# Compares parse_funcs against the BeautifulSoup implementation it replaced:
+# every page must give the same record, then both are timed.
+#
+#   python bench_extract.py                   # synthetic pages
+#   python bench_extract.py --pages saved/    # *.html profile pages on disk
+
+
+def soup_get_urls(html):
+    soup = BeautifulSoup(html, 'html.parser')
+
+    return ['https://www.healthgrades.com' + li.a['href'] for li in soup.find_all('li', class_='link-column__list')]
+
+
+def soup_parse(url, html):
+    try:
+        soup = BeautifulSoup(html, 'lxml')
+
+        try:
+            biography = soup.find(
+                attrs={'data-qa-target': 'premium-biography'}).get_text(strip=True)
+            name = biography.split(',')[0]
+        except AttributeError:
+            biography = 'Not given'
+            name = 'Not given'
+
+        try:
+            gender = soup.find(
+                attrs={'data-qa-target': 'ProviderDisplayGender'}).get_text(strip=True)
+        except AttributeError:
+            gender = 'Not given'
+
+        try:
+            age = soup.find(
+                attrs={'data-qa-target': 'ProviderDisplayAge'}).get_text(strip=True).replace('•\xa0Age', '')
+        except AttributeError:
+            age = 'Not given'
+
+        try:
+            phone = soup.find_all(
+                attrs={'data-qa-target': 'pdc-summary-new-patients-button'})[-1]['href'][4:]
+        except:
+            try:
+                phone = soup.find(
+                    attrs={'data-hgoname': 'summary-new-phone-number'})['href'][4:]
+            except:
+                phone = 'Not given'
+
+        try:
+            rating = float(soup.find(class_='score').find(
+                'strong').get_text(strip=True))
+        except:
+            rating = 'Not given'
+
+        try:
+            try:
+                ratingCount = int(
+                    soup.find(class_='review-pill').find('small').get_text(strip=True))
+            except AttributeError:
+                ratingCount = int(soup.find(
+                    class_='review-count').get_text(strip=True).replace('(', '').replace(')', ''))
+        except ValueError:
+            ratingCount = 0
+
+        try:
+            awards = soup.find(attrs={'data-qa-target': 'about-me-awards'}
+                               ).get_text(strip=True).replace('Awards', '', 1)
+        except AttributeError:
+            awards = 'Not given'
+
+        raw_locations = soup.find_all('div', class_='office-title')
+        locations = ';'.join([location.get_text(
+            strip=True) for location in raw_locations]) if len(raw_locations) else 'Not given'
+
+        return {
+            'Name': name,
+            'Gender': gender,
+            'Age': age,
+            'Phone': phone,
+            'Rating': rating,
+            'Rating count': ratingCount,
+            'URL': url,
+            'Locations': locations,
+            'Awards': awards,
+            'Biography': biography,
+        }
+
+    except Exception:
+        return None
+
+
+def load_pages(path, count):
+    if path:
+        pages = []
+        for name in sorted(glob.glob(os.path.join(path, '*.html'))):
+            with open(name, 'rb') as f:
+                pages.append((name, f.read()))
+        return pages
+    return [('sample-%s' % i, profile_bytes(i)) for i in range(count)]
+
+
+def timed(func, pages, rounds):
+    best = None
+    for _ in range(rounds):
+        start = perf_counter()
+        for url, html in pages:
+            func(url, html)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark profile extraction.')
+    parser.add_argument('--pages', help='directory of saved *.html profile pages')
+    parser.add_argument('--count', type=int, default=300, help='synthetic pages to generate')
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    parse_funcs.logger.disabled = True
+
+    pages = load_pages(args.pages, args.count)
+    if not pages:
+        raise SystemExit('No pages found')
+
+    for url, html in pages:
+        expected, actual = soup_parse(url, html), parse_funcs.parse_page(url, html)[0]
+        assert expected == actual, '%s\n%s\n%s' % (url, expected, actual)
+
+    listings = [listing_page(letter, 1).encode('utf-8') for letter in 'abcdefghij']
+    for html in listings:
+        assert soup_get_urls(html) == parse_funcs.get_urls(html)
+
+    size = sum(len(html) for _, html in pages) / len(pages) / 1024
+    print('%s profile pages, %.1f KiB each, all records identical' % (len(pages), size))
+    old = timed(soup_parse, pages, args.rounds)
+    new = timed(parse_funcs.parse_page, pages, args.rounds)
+    print('parse     bs4 %8.1f pages/s   lxml %8.1f pages/s   %.1fx'
+          % (len(pages) / old, len(pages) / new, old / new))
+
+    listings = [(None, html) for html in listings]
+    old = timed(lambda url, html: soup_get_urls(html), listings, args.rounds)
+    new = timed(lambda url, html: parse_funcs.get_urls(html), listings, args.rounds)
+    print('get_urls  bs4 %8.1f pages/s   lxml %8.1f pages/s   %.1fx'
+          % (len(listings) / old, len(listings) / new, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import logging
+import os
+import sqlite3
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS letters (
+    letter TEXT PRIMARY KEY,
+    page INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS profiles (
+    url TEXT PRIMARY KEY,
+    done INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+
+
+class Checkpoint(object):
+    # Crawl progress in a small SQLite file: the next listing page of every
+    # letter, and every profile URL discovered with whether its record is
+    # safely in the output. A listing page's URLs are stored in the same
+    # transaction that moves its letter's cursor on, so a crash can never
+    # lose URLs, and profiles are only marked done once the sink has made
+    # their records durable.
+    #
+    # Used from the event loop and from the writer's executor thread.
+
+    def __init__(self, path, fresh=False):
+        if fresh and os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.resumed = self.conn.execute('SELECT COUNT(*) FROM letters').fetchone()[0] > 0
+
+    @property
+    def offset(self):
+        # Bytes of the TSV output that are covered by done profiles
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'offset'").fetchone()
+        return row[0] if row else 0
+
+    def cursor(self, letter):
+        # (next page, letter finished)
+        with self.lock:
+            row = self.conn.execute('SELECT page, done FROM letters WHERE letter = ?',
+                                    (letter,)).fetchone()
+        return (row[0], bool(row[1])) if row else (1, False)
+
+    def page_done(self, letter, page, urls):
+        # Returns the URLs to fetch; a single crawler owns them all
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO profiles (url) VALUES (?)',
+                                  ((url,) for url in urls))
+            self.conn.execute('INSERT OR REPLACE INTO letters (letter, page, done) VALUES (?, ?, 0)',
+                              (letter, page + 1))
+        return urls
+
+    def letter_done(self, letter):
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE letters SET done = 1 WHERE letter = ?', (letter,))
+
+    def owned(self, urls):
+        return set(urls)
+
+    def profiles_done(self, urls, offset=None):
+        with self.lock, self.conn:
+            self.conn.executemany('UPDATE profiles SET done = 1 WHERE url = ?',
+                                  ((url,) for url in urls))
+            if offset is not None:
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('offset', ?)",
+                                  (offset,))
+
+    def _urls(self, where, chunk):
+        # Rows added after this call are left out; the crawl that adds them
+        # queues them itself
+        with self.lock:
+            end = self.conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM profiles').fetchone()[0]
+        return self._iter_urls(where, chunk, end)
+
+    def _iter_urls(self, where, chunk, end):
+        # Reads in rowid order a chunk at a time so millions of URLs never
+        # sit in memory at once
+        last = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute('SELECT rowid, url FROM profiles WHERE rowid > ? AND rowid <= ? %s '
+                                         'ORDER BY rowid LIMIT ?' % where, (last, end, chunk)).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            for _, url in rows:
+                yield url
+
+    def known(self, chunk=10000):
+        return self._urls('', chunk)
+
+    def pending(self, chunk=10000):
+        return self._urls('AND done = 0', chunk)
+
+    def progress(self):
+        with self.lock:
+            total, done = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(done), 0) FROM profiles').fetchone()
+            letters = self.conn.execute('SELECT COUNT(*) FROM letters WHERE done = 1').fetchone()[0]
+        return {'profiles': total, 'profiles_done': done, 'letters_done': letters}
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,93 @@
+import codecs
+import re
+import lxml.html
+from lxml import etree
+
+
+# Declarative field extraction on raw lxml trees. A spec maps field names to
+# Field selectors; Extractor compiles every XPath once at import time and
+# each page is then a single parse plus one compiled query per field.
+
+
+# Text of an element the way BeautifulSoup's get_text(strip=True) returns it:
+# every text node stripped and joined, script/style/template content skipped
+_TEXT = etree.XPath('.//text()[not(parent::script or parent::style or ancestor::template)]',
+                    smart_strings=False)
+
+
+def text(el):
+    return ''.join(s.strip() for s in _TEXT(el))
+
+
+# Pages reach lxml as UTF-8 bytes with the encoding given explicitly, so
+# libxml2 never falls back to reading undeclared UTF-8 as Latin-1
+HTML_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+ETREE_PARSER = etree.HTMLParser(encoding='utf-8')
+
+_DECLARED = re.compile(br'<meta[^>]+charset\s*=\s*["\']?\s*([-\w.:]+)', re.I)
+
+
+def utf8(html, charset=None):
+    # The page as UTF-8 bytes, decoded with the HTTP charset, else a <meta>
+    # declaration, else UTF-8 if it is valid, else windows-1252: the order
+    # BeautifulSoup's UnicodeDammit tries them in without chardet
+    if isinstance(html, str):
+        return html.encode('utf-8')
+    declared = _DECLARED.search(html)
+    for encoding in (charset, declared and declared.group(1).decode('ascii')):
+        if not encoding:
+            continue
+        try:
+            text = html.decode(encoding)
+        except (LookupError, UnicodeDecodeError):
+            continue
+        return html if codecs.lookup(encoding).name == 'utf-8' else text.encode('utf-8')
+    try:
+        html.decode('utf-8')
+        return html
+    except UnicodeDecodeError:
+        return html.decode('windows-1252', 'replace').encode('utf-8')
+
+
+def by_attr(name, value):
+    return '//*[@%s="%s"]' % (name, value)
+
+
+def by_class(name, tag='*'):
+    # The plain substring test rejects most elements before the token match
+    return ('//%s[contains(@class, "%s")][contains(concat(" ", normalize-space(@class), " "), " %s ")]'
+            % (tag, name, name))
+
+
+class Field(object):
+    # pick: 'first' or 'last' match, or 'all' for a list.
+    # attr: return this attribute instead of the element's text.
+
+    def __init__(self, xpath, pick='first', attr=None):
+        self.xpath = xpath
+        self.pick = pick
+        self.attr = attr
+        self.query = etree.XPath(xpath, smart_strings=False)
+
+    def value(self, el):
+        if self.attr is None:
+            return text(el)
+        return el.get(self.attr)
+
+    def __call__(self, tree):
+        matches = self.query(tree)
+        if self.pick == 'all':
+            return [self.value(el) for el in matches]
+        if not matches:
+            return None
+        return self.value(matches[0] if self.pick == 'first' else matches[-1])
+
+
+class Extractor(object):
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def __call__(self, html, charset=None):
+        tree = lxml.html.fromstring(utf8(html, charset), parser=HTML_PARSER)
+        return {name: field(tree) for name, field in self.spec.items()}
@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import math
+
+
+class BloomFilter(object):
+    # Compact seen-set. Each item sets `hashes` bits derived from a single
+    # blake2b digest (double hashing). False positives happen at roughly
+    # error_rate once `capacity` items are in; false negatives never do.
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        # Returns True if the item was not seen before
+        new = False
+        for pos in self._positions(item):
+            byte, bit = divmod(pos, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, item):
+        return all(self.bits[pos // 8] & (1 << (pos % 8)) for pos in self._positions(item))
+
+    def __len__(self):
+        return self.count
+
+
+class Frontier(object):
+    # Profile URLs waiting to be fetched. put() drops URLs already seen and
+    # blocks once maxsize URLs are pending, which holds the crawlers back
+    # until the fetch stage catches up. Memory is the queue bound plus the
+    # fixed size bit array.
+
+    def __init__(self, maxsize, capacity, error_rate=0.001):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.seen = BloomFilter(capacity, error_rate)
+        self.discovered = 0
+        self.duplicates = 0
+        self.enqueued = 0
+        self.completed = 0
+        self.retried = 0
+        # Failed fetches so far of URLs being retried
+        self.attempts = {}
+
+    async def put(self, url):
+        self.discovered += 1
+        if not self.seen.add(url):
+            self.duplicates += 1
+            return False
+        await self.queue.put(url)
+        self.enqueued += 1
+        return True
+
+    def seed(self, urls):
+        # Marks URLs from an earlier run as seen without queueing them
+        for url in urls:
+            self.seen.add(url)
+
+    async def requeue(self, url):
+        # Queues a URL already in the seen-set, e.g. one left pending by an
+        # interrupted run
+        await self.queue.put(url)
+        self.enqueued += 1
+
+    async def retry(self, url, delay):
+        # Puts a URL whose fetch failed back after delay; call it instead
+        # of task_done(). The URL counts as unfinished until it is back, so
+        # join() waits for the retry.
+        self.retried += 1
+        await asyncio.sleep(delay)
+        await self.queue.put(url)
+        self.queue.task_done()
+
+    def failed(self, url):
+        # Records a failed fetch; returns how many the URL has had
+        attempts = self.attempts[url] = self.attempts.get(url, 0) + 1
+        return attempts
+
+    def forget(self, url):
+        self.attempts.pop(url, None)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def task_done(self):
+        self.completed += 1
+        self.queue.task_done()
+
+    async def join(self):
+        await self.queue.join()
+
+    def progress(self):
+        return {
+            'discovered': self.discovered,
+            'duplicates': self.duplicates,
+            'enqueued': self.enqueued,
+            'completed': self.completed,
+            'retried': self.retried,
+            'pending': self.queue.qsize(),
+        }
@@ -1,22 +1,69 @@
 import aiohttp
+import argparse
 import asyncio
 import string
-import sys
 import logging
-from multiprocessing import Pool
-from time import sleep, time
-from bs4 import BeautifulSoup
-from parse_funcs import parse, get_urls
+from concurrent.futures import ProcessPoolExecutor
+import socket
+from time import monotonic, sleep, time
+from checkpoint import Checkpoint
+from frontier import Frontier
+from metrics import Metrics
+from parse_funcs import parse_page, get_urls
+from scheduler import THROTTLED, Scheduler
+from sinks import EXTENSIONS, FORMATS, open_sink
+from workqueue import LEASE_TTL, RANGE_SIZE, WorkQueue
 
 
 
-URL = 'https://www.healthgrades.com/affiliated-physicians/{letter}-{pageNo}'
+BASE_URL = 'https://www.healthgrades.com'
+URL = '{base}/affiliated-physicians/{letter}-{pageNo}'
 
 
 LETTERS = [letter for letter in string.ascii_lowercase]
 
 
-scraped_counter = 0
+# Parse processes for the whole run, the most concurrent requests the
+# scheduler may grow to, and how many items may wait between stages
+# before the stage in front blocks
+WORKERS = 16
+FETCH_CONCURRENCY = 32
+INITIAL_CONCURRENCY = 8
+QUEUE_SIZE = WORKERS * 8
+
+# Expected number of distinct profile URLs; sizes the frontier's seen-set
+SEEN_CAPACITY = 2000000
+
+# Records per write and the longest a partial batch waits before flushing
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 5
+
+# Requests per second across the whole crawl
+RATE = 50
+
+# Retries of a listing page before its letter is abandoned, or of a
+# profile before it is dropped, and the first backoff
+MAX_RETRIES = 5
+RETRY_DELAY = 1
+
+# Seconds between full tracebacks of the same kind of failure; the rest
+# are only counted in the metrics
+TRACEBACK_INTERVAL = 60
+
+CHECKPOINT = 'crawl.sqlite'
+
+# Metrics file, how often it and the log summary are refreshed, and how
+# many pages pass between per page debug lines
+METRICS = 'metrics.json'
+METRICS_INTERVAL = 10
+LOG_EVERY = 100
+
+# Work queue shared between nodes, concurrent leases per worker node, and
+# how often idle workers and the coordinator look at it
+QUEUE = 'queue.sqlite'
+LEASES = 8
+LEASE_POLL = 5
+REPORT_INTERVAL = 30
 
 
 handler = logging.StreamHandler()
@@ -27,98 +74,421 @@ logger.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
 
-async def loop_through(session, l):
-    global scraped_counter
+class HTTPError(IOError):
 
-    i = 1
-    _urls = []
+    def __init__(self, status, url):
+        super(HTTPError, self).__init__('HTTP %s for %s' % (status, url))
+        self.status = status
+
+
+def retryable(e):
+    # Throttling, server errors and dropped connections; not client errors
+    if isinstance(e, HTTPError):
+        return e.status in THROTTLED or e.status >= 500
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
 
-    while True:
 
-        url = URL.format(letter=l, pageNo=i) # Format URL by passing letter and counter i
-        logger.debug('Crawling %s', url)
+_tracebacks = {}
+
+
+def log_failure(where, e):
+    # Logs a traceback per kind of failure at most every TRACEBACK_INTERVAL
+    kind = (where, getattr(e, 'status', None) or type(e).__name__)
+    now = monotonic()
+    if now - _tracebacks.get(kind, -TRACEBACK_INTERVAL) >= TRACEBACK_INTERVAL:
+        _tracebacks[kind] = now
+        logger.exception('Exception found in %s: %s', where, e)
+
+
+async def loop_through(session, scheduler, l, frontier, checkpoint=None,
+                       metrics=None, base_url=BASE_URL, first=None, last=None):
+    # Crawls letter l's listing pages from `first` (default: the checkpoint's
+    # cursor) through `last` (default: the end of the chain). Returns True
+    # at the end of the chain, False once `last` is done, and None if it
+    # gave up on a page.
+
+    if first is not None:
+        i, done = first, False
+    else:
+        i, done = checkpoint.cursor(l) if checkpoint else (1, False)
+    if done:
+        return True
+    retries = 0
+
+    while last is None or i <= last:
+
+        url = URL.format(base=base_url, letter=l, pageNo=i) # Format URL by passing letter and counter i
 
         try:
-            
 
-            async with session.get(url, allow_redirects=True) as r:
+            start = monotonic()
+            final_url, status, html, charset = await scheduler.fetch(session, url, allow_redirects=True)
 
-                if url == str(r.url):
+            if status >= 400:
+                raise HTTPError(status, url)
 
-                    html = await r.text()
+            if url == final_url:
 
+                urls = get_urls(html, base_url, charset)
+                if metrics:
+                    metrics.stages['listing'].record(start, size=len(html))
+                    metrics.observe('listing_seconds', monotonic() - start)
+                    pages = metrics.inc('listing_pages')
+                if checkpoint:
+                    urls = checkpoint.page_done(l, i, urls)
 
-                    _urls.extend(get_urls(html))
-                    scraped_counter += len(_urls)
+                # Blocks while the fetch stage is behind
+                new = 0
+                for profile_url in urls:
+                    new += await frontier.put(profile_url)
+                if not metrics or pages % LOG_EVERY == 1:
+                    logger.debug('%s: %s new URLs\t%s', url, new, frontier.progress())
 
+                i += 1
+                retries = 0
 
-                    if sys.getsizeof(_urls) > 2000:
-                        logger.info(
-                            'Memory is depleted. Starting to parse %s URLs', len(_urls))
 
-                        start = time()
-                        
+            else:
+                if checkpoint:
+                    checkpoint.letter_done(l)
+                return True
 
-                        with Pool(16) as p:
-                            p.map(parse, _urls)
+        except Exception as e:
+            log_failure('loop through', e)
+            if metrics:
+                metrics.fail('listing', e)
+            retries += 1
+            if retries > MAX_RETRIES:
+                logger.error('Giving up on letter %s at page %s', l, i)
+                return None
+            await asyncio.sleep(RETRY_DELAY * 2 ** (retries - 1))
 
-                        finish = time()
-                        
-                       
-                        logger.debug('Scraped: %s\tSpeed: %s URLs/second\tTotal: %s', len(
-                            _urls), round(len(_urls)/(finish-start), 2), scraped_counter)
+    return False
 
-                       
-                        _urls.clear()
 
-                        logger.debug('URLs list has been cleared: %s', _urls)
-                    
+async def lease_worker(session, scheduler, frontier, queue, metrics, base_url):
+    # Worker mode: crawls page ranges leased from the shared work queue until
+    # the whole crawl is finished
+    while True:
+        lease = queue.lease()
+        if lease is None:
+            if queue.finished():
+                return
+            for url in queue.adopt():
+                await frontier.put(url)
+            await asyncio.sleep(LEASE_POLL)
+            continue
+
+        letter, first, last = lease
+        reached_end = await loop_through(session, scheduler, letter, frontier, queue,
+                                         metrics, base_url, first, last)
+        if reached_end is None:
+            queue.release(letter, first)
+        else:
+            queue.complete(letter, first, last, reached_end)
+
+
+async def heartbeat_worker(queue):
+    # Keeps this node's leases and profile claims alive
+    while True:
+        await asyncio.sleep(queue.lease_ttl / 3)
+        queue.heartbeat()
 
-                    i += 1
-                
 
+async def fetch_worker(session, scheduler, frontier, html_queue, metrics):
+    # Stage one: download each profile once and pass the raw bytes on.
+    # Throttled and failed fetches go back on the frontier with backoff,
+    # up to MAX_RETRIES times.
+    while True:
+        url = await frontier.get()
+        retry = None
+        try:
+            start = monotonic()
+            _, status, html, charset = await scheduler.fetch(session, url)
+            if status >= 400:
+                raise HTTPError(status, url)
+            metrics.stages['fetch'].record(start, size=len(html))
+            metrics.observe('fetch_seconds', monotonic() - start)
+            metrics.inc('bytes_downloaded', len(html))
+            if metrics.inc('profiles_fetched') % LOG_EVERY == 1:
+                logger.debug('Fetched %s\t%s', url, frontier.progress())
+            frontier.forget(url)
+            await html_queue.put((url, html, charset))
+        except Exception as e:
+            log_failure('fetch worker', e)
+            metrics.fail('fetch', e)
+            if retryable(e):
+                attempts = frontier.failed(url)
+                if attempts <= MAX_RETRIES:
+                    retry = RETRY_DELAY * 2 ** (attempts - 1)
                 else:
-                    break
-    
+                    logger.error('Giving up on %s', url)
+                    frontier.forget(url)
+                    metrics.inc('profiles_dropped')
+        finally:
+            if retry is None:
+                frontier.task_done()
+            else:
+                metrics.inc('profile_retries')
+                asyncio.ensure_future(frontier.retry(url, retry))
+
+
+async def parse_worker(html_queue, record_queue, pool, metrics):
+    # Stage two: parse downloaded pages in the shared process pool. The pool
+    # reports its own parse time and failures along with the record.
+    loop = asyncio.get_event_loop()
+    while True:
+        url, html, charset = await html_queue.get()
+        try:
+            start = monotonic()
+            record, seconds, failure = await loop.run_in_executor(pool, parse_page, url, html,
+                                                                     charset)
+            metrics.stages['parse'].record(start)
+            metrics.observe('parse_seconds', seconds)
+            if failure:
+                metrics.fail('parse', failure)
+            if record:
+                await record_queue.put(record)
         except Exception as e:
-            logger.exception('Exception found in loop through: %s', e)
+            log_failure('parse worker', e)
+            metrics.fail('parse', e)
+        finally:
+            html_queue.task_done()
+
+
+def commit_batch(sink, checkpoint, batch):
+    if checkpoint:
+        # In worker mode another node may have taken over some of these
+        owned = checkpoint.owned([record['URL'] for record in batch])
+        batch = [record for record in batch if record['URL'] in owned]
+    sink.write_batch(batch)
+    if checkpoint:
+        urls, offset = sink.sync()
+        checkpoint.profiles_done(urls, offset)
+    return len(batch)
+
+
+async def write_worker(record_queue, sink, metrics, batch_size=BATCH_SIZE, checkpoint=None,
+                       parsed=None):
+    # Stage three: the only writer. Buffers records and flushes a batch when
+    # it is full or FLUSH_INTERVAL passes, off the event loop thread. Once
+    # the parse stage is done (the `parsed` event) no more records can come,
+    # so what is left is flushed at once.
+    loop = asyncio.get_event_loop()
+    while True:
+        batch = [await record_queue.get()]
+        deadline = loop.time() + FLUSH_INTERVAL
+        while len(batch) < batch_size:
+            if not record_queue.empty():
+                batch.append(record_queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0 or (parsed and parsed.is_set()):
+                break
+            get = asyncio.ensure_future(record_queue.get())
+            waits = {get, asyncio.ensure_future(parsed.wait())} if parsed else {get}
+            done, pending = await asyncio.wait(waits, timeout=timeout,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            if get in done:
+                batch.append(get.result())
+        try:
+            start = monotonic()
+            written = await loop.run_in_executor(None, commit_batch, sink, checkpoint, batch)
+            metrics.stages['write'].record(start, items=written)
+            metrics.observe('write_seconds', monotonic() - start)
+            metrics.inc('records_written', written)
+        except Exception as e:
+            logger.exception('Exception found in write worker: %s', e)
+            metrics.fail('write', e)
+        finally:
+            for _ in batch:
+                record_queue.task_done()
 
 
-# Main function
-async def main1():
-    for i in range(4):
+async def report_worker(metrics, path, frontier, scheduler):
+    # Periodic summary in the log and, if a path is given, the full metrics
+    # as JSON for other tools to poll
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        logger.info('%s\t%s', metrics.summary_line(), frontier.progress())
+        if path:
+            metrics.write(path, frontier=frontier.progress(), scheduler=scheduler.progress())
 
 
-        left = round(len(LETTERS)/4*i)
-        right = round(len(LETTERS)/4*(i+1))
-        logger.debug('ROUND NUMBER %s\nPARSING from %s to %s', i, left, right)
+async def requeue_pending(frontier, checkpoint):
+    count = 0
+    for url in checkpoint.pending():
+        await frontier.requeue(url)
+        count += 1
+    logger.debug('Requeued %s profiles from the checkpoint', count)
 
-        try:
-           
-            async with aiohttp.ClientSession() as session:
-                await asyncio.gather(*(loop_through(session, letter) for letter in LETTERS[left:right]))
-                
 
-            sleep(1.5)
-                
-        except Exception as e:
-            logger.exception('Exception found in main: %s', e)
+# Main function
+async def main1(sink, workers=WORKERS, fetch_concurrency=FETCH_CONCURRENCY,
+                batch_size=BATCH_SIZE, seen_capacity=SEEN_CAPACITY,
+                rate=RATE, burst=None, checkpoint=None, letters=LETTERS, base_url=BASE_URL,
+                workqueue=None, metrics_path=None):
+    # Returns the frontier and the run's Metrics. With a workqueue this node
+    # crawls leased page ranges, and the queue also takes the checkpoint's
+    # place.
+    metrics = Metrics()
+    frontier = Frontier(QUEUE_SIZE, seen_capacity)
+    if workqueue:
+        checkpoint = workqueue
+        workqueue.heartbeat()
+    elif checkpoint:
+        frontier.seed(checkpoint.known())
+    html_queue = asyncio.Queue(maxsize=workers * 2)
+    record_queue = asyncio.Queue(maxsize=batch_size * 2)
+    parsed = asyncio.Event()
+    scheduler = Scheduler(rate, burst, initial=min(INITIAL_CONCURRENCY, fetch_concurrency),
+                          maximum=fetch_concurrency, metrics=metrics)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        async with aiohttp.ClientSession() as session:
+            # The scheduler decides how many of these are actually fetching
+            tasks = [asyncio.ensure_future(fetch_worker(session, scheduler, frontier, html_queue, metrics))
+                     for _ in range(fetch_concurrency)]
+            tasks += [asyncio.ensure_future(parse_worker(html_queue, record_queue, pool, metrics))
+                      for _ in range(workers)]
+            tasks.append(asyncio.ensure_future(write_worker(record_queue, sink, metrics, batch_size,
+                                                            checkpoint, parsed)))
+            tasks.append(asyncio.ensure_future(report_worker(metrics, metrics_path, frontier, scheduler)))
+            if workqueue:
+                tasks.append(asyncio.ensure_future(heartbeat_worker(workqueue)))
+
+            try:
+                # Every letter runs to the end of its own chain; the scheduler
+                # spreads requests between them and the profile fetches.
+                # Profiles an interrupted run found but never wrote go first.
+                if workqueue:
+                    for url in workqueue.adopt(include_own=True):
+                        await frontier.put(url)
+                    crawlers = [lease_worker(session, scheduler, frontier, workqueue, metrics, base_url)
+                                for _ in range(LEASES)]
+                else:
+                    crawlers = [loop_through(session, scheduler, letter, frontier, checkpoint,
+                                             metrics, base_url)
+                                for letter in letters]
+                    if checkpoint:
+                        crawlers.append(requeue_pending(frontier, checkpoint))
+                await asyncio.gather(*crawlers)
+                logger.debug('Listing pages done\t%s', scheduler.progress())
+
+                start = time()
+                await frontier.join()
+                await html_queue.join()
+                parsed.set()
+                await record_queue.join()
+                logger.debug('Pipeline drained in %s seconds\t%s', round(time() - start, 2),
+                             scheduler.progress())
+
+            finally:
+                # Also on errors and cancellation, so no stage outlives the run
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                if metrics_path:
+                    metrics.write(metrics_path, frontier=frontier.progress(),
+                                  scheduler=scheduler.progress())
+
+    return frontier, metrics
+
+
+def coordinate(queue, letters=LETTERS):
+    # Coordinator mode: seeds the work queue and reports until every range
+    # and every claimed profile is done. Workers may start before or after.
+    queue.seed(letters)
+    while True:
+        progress = queue.progress()
+        logger.info('Crawl progress\t%s', progress)
+        if progress['ranges'] == progress['ranges_done'] and \
+                progress['profiles'] == progress['profiles_done']:
+            return progress
+        sleep(REPORT_INTERVAL)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Scrape physician profiles.')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='parse processes')
+    parser.add_argument('--fetch-concurrency', type=int, default=FETCH_CONCURRENCY,
+                        help='most concurrent requests')
+    parser.add_argument('--rate', type=float, default=RATE,
+                        help='requests per second')
+    parser.add_argument('--burst', type=int,
+                        help='requests allowed at once after idling (default: rate)')
+    parser.add_argument('--format', choices=FORMATS, default='tsv',
+                        help='output format')
+    parser.add_argument('--output', help='output file (default data.<ext>)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='records per write')
+    parser.add_argument('--seen-capacity', type=int, default=SEEN_CAPACITY,
+                        help='expected distinct profile URLs')
+    parser.add_argument('--checkpoint', default=CHECKPOINT,
+                        help='progress file; an existing one resumes its crawl')
+    parser.add_argument('--fresh', action='store_true',
+                        help='discard the checkpoint and start over')
+    parser.add_argument('--base-url', default=BASE_URL,
+                        help='site to crawl, e.g. a local replay server')
+    parser.add_argument('--metrics', default=METRICS,
+                        help='JSON metrics file, rewritten every %s seconds' % METRICS_INTERVAL)
+    parser.add_argument('--mode', choices=('single', 'coordinator', 'worker'), default='single',
+                        help='crawl alone, or share a work queue between nodes')
+    parser.add_argument('--queue', default=QUEUE,
+                        help='work queue file shared by the coordinator and workers '
+                             '(all on the host that holds it)')
+    parser.add_argument('--node', default=socket.gethostname(),
+                        help='this worker\'s name; reuse it to resume a worker')
+    parser.add_argument('--range-size', type=int, default=RANGE_SIZE,
+                        help='listing pages per leased range')
+    parser.add_argument('--lease-ttl', type=float, default=LEASE_TTL,
+                        help='seconds a worker\'s lease survives without a heartbeat')
+    return parser
 
 
 if __name__ == '__main__':
+    args = build_parser().parse_args()
+
     start_time = time()
 
 
-    with open('data.csv', 'w') as f:
-        f.write('')
-    
+    if args.mode == 'coordinator':
+        queue = WorkQueue(args.queue, 'coordinator', args.range_size, args.lease_ttl)
+        coordinate(queue)
+        queue.close()
+        raise SystemExit
+
+    workqueue = None
+    if args.mode == 'worker':
+        # Each node writes its own file; together they hold every profile once
+        checkpoint = workqueue = WorkQueue(args.queue, args.node, args.range_size, args.lease_ttl)
+        output = args.output or 'data.%s.%s' % (args.node, EXTENSIONS[args.format])
+    else:
+        checkpoint = Checkpoint(args.checkpoint, fresh=args.fresh)
+        output = args.output or 'data.' + EXTENSIONS[args.format]
+    if checkpoint.resumed:
+        logger.debug('Resuming\t%s', checkpoint.progress())
 
-    asyncio.run(main1())
+    sink = open_sink(output, args.format, checkpoint.resumed, checkpoint.offset)
+
+
+    frontier, metrics = asyncio.run(main1(sink, args.workers, args.fetch_concurrency,
+                                          args.batch_size, args.seen_capacity,
+                                          args.rate, args.burst, checkpoint,
+                                          base_url=args.base_url, workqueue=workqueue,
+                                          metrics_path=args.metrics))
+
+    checkpoint.profiles_done(*sink.close())
+    checkpoint.close()
 
     finish_time = time()
-    
+
 
     t = finish_time - start_time
-    
-    # Print 
-    logger.debug('Time taken %s for %s URLs', t, scraped_counter)
+
+    # Print
+    logger.debug('Time taken %s for %s URLs\t%s', t, frontier.enqueued, frontier.progress())
+    logger.info(metrics.summary_line())
@@ -0,0 +1,139 @@
+import json
+import os
+from bisect import bisect_left
+from collections import defaultdict
+from time import monotonic, time
+
+
+# Bucket upper bounds in seconds, 1ms doubling up to about a minute
+LATENCY_BOUNDS = [0.001 * 2 ** i for i in range(17)]
+
+
+class Histogram(object):
+    # Fixed buckets, so observing is cheap and quantiles are approximate:
+    # they report the upper bound of the bucket the quantile falls in
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': round(self.sum / self.count, 4) if self.count else 0,
+            'min': round(self.min or 0, 4),
+            'p50': round(self.quantile(0.5), 4),
+            'p90': round(self.quantile(0.9), 4),
+            'p99': round(self.quantile(0.99), 4),
+            'max': round(self.max or 0, 4),
+        }
+
+
+class Stage(object):
+    # Items through one pipeline stage, the time they spent in it, and the
+    # span from the stage's first start to its last finish
+
+    def __init__(self):
+        self.items = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+
+    def record(self, start, items=1, size=0):
+        end = monotonic()
+        self.started = start if self.started is None else min(self.started, start)
+        self.finished = end
+        self.items += items
+        self.bytes += size
+        self.busy += end - start
+
+    def summary(self):
+        span = self.finished - self.started if self.items else 0
+        return {
+            'items': self.items,
+            'bytes': self.bytes,
+            'seconds': round(span, 3),
+            'per_second': round(self.items / span, 1) if span else 0,
+            'mean_latency': round(self.busy / self.items, 4) if self.items else 0,
+        }
+
+
+class Metrics(object):
+    # Counters, histograms and stage totals for one crawl. Only the main
+    # process updates them; the parse pool sends its numbers back with each
+    # record. Failures are counted per stage and exception type.
+
+    STAGES = ('listing', 'fetch', 'parse', 'write')
+
+    def __init__(self):
+        self.started = time()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.stages = {stage: Stage() for stage in self.STAGES}
+        self.failures = defaultdict(int)
+
+    def inc(self, name, n=1):
+        self.counters[name] += n
+        return self.counters[name]
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def fail(self, stage, kind):
+        # kind is an exception or its type name; HTTP errors count by status
+        if isinstance(kind, BaseException):
+            status = getattr(kind, 'status', None)
+            kind = 'HTTP%s' % status if status else type(kind).__name__
+        self.failures['%s.%s' % (stage, kind)] += 1
+
+    def snapshot(self, **extra):
+        data = {
+            'time': round(time(), 3),
+            'elapsed': round(time() - self.started, 3),
+            'counters': dict(self.counters),
+            'failures': dict(self.failures),
+            'histograms': {name: h.summary() for name, h in self.histograms.items()},
+            'stages': {name: s.summary() for name, s in self.stages.items()},
+        }
+        data.update(extra)
+        return data
+
+    def write(self, path, **extra):
+        # Atomic, so a reader polling the file never sees half of it
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(**extra), f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def summary_line(self):
+        request = self.histograms['request_seconds']
+        parse = self.histograms['parse_seconds']
+        return ('fetched %s (%.1f MiB, request p50 %.3fs p99 %.3fs), parsed %s (p50 %.4fs), '
+                'written %s, failures %s' % (
+                    self.counters['profiles_fetched'], self.counters['bytes_downloaded'] / 2 ** 20,
+                    request.quantile(0.5), request.quantile(0.99), parse.count,
+                    parse.quantile(0.5), self.counters['records_written'],
+                    dict(self.failures)))
@@ -1,7 +1,7 @@
-import csv
 import logging
-import requests
-from bs4 import BeautifulSoup
+from time import perf_counter
+from lxml import etree
+from extract import ETREE_PARSER, Extractor, Field, by_attr, by_class, utf8
 
 
 handler = logging.StreamHandler()
@@ -11,108 +11,101 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
-scraped_count = 1
 
+BASE_URL = 'https://www.healthgrades.com'
 
-def get_urls(html):
-    soup = BeautifulSoup(html, 'html.parser')
 
-    return ['https://www.healthgrades.com' + li.a['href'] for li in soup.find_all('li', class_='link-column__list')]
+# Profile fields, compiled once per process
+PROFILE = Extractor({
+    'biography': Field(by_attr('data-qa-target', 'premium-biography')),
+    'gender': Field(by_attr('data-qa-target', 'ProviderDisplayGender')),
+    'age': Field(by_attr('data-qa-target', 'ProviderDisplayAge')),
+    'phone_button': Field(by_attr('data-qa-target', 'pdc-summary-new-patients-button'),
+                          pick='last', attr='href'),
+    'phone_link': Field(by_attr('data-hgoname', 'summary-new-phone-number'), attr='href'),
+    'rating': Field('(%s)[1]//strong' % by_class('score')),
+    'review_pill': Field('(%s)[1]//small' % by_class('review-pill')),
+    'review_count': Field(by_class('review-count')),
+    'awards': Field(by_attr('data-qa-target', 'about-me-awards')),
+    'locations': Field(by_class('office-title', 'div'), pick='all'),
+})
 
+# href of the first link in every listing entry
+LINKS = etree.XPath(by_class('link-column__list', 'li') + '/descendant::a[1]/@href',
+                    smart_strings=False)
 
-# Fucntion to parse given HTML/URL
-def parse(url, html=None):
-    global scraped_count
 
-    logger.debug('Processing: %s\t\tCount: %s', url, scraped_count)
+def get_urls(html, base=BASE_URL, charset=None):
+    return [base + href for href in LINKS(etree.HTML(utf8(html, charset), ETREE_PARSER))]
 
-    try:
-        if not html:
-            html = requests.get(url).text
-
-        soup = BeautifulSoup(html, 'lxml')
-
-        try:
-            biography = soup.find(
-                attrs={'data-qa-target': 'premium-biography'}).get_text(strip=True)
-            name = biography.split(',')[0]
-        except AttributeError:
-            logger.warning('Biograhy and name were not found %s', url)
-            biography = 'Not given'
-            name = 'Not given'
-
-        try:
-            gender = soup.find(
-                attrs={'data-qa-target': 'ProviderDisplayGender'}).get_text(strip=True)
-        except AttributeError:
-            gender = 'Not given'
-
-        try:
-            age = soup.find(
-                attrs={'data-qa-target': 'ProviderDisplayAge'}).get_text(strip=True).replace('•\xa0Age', '')
-        except AttributeError:
-            age = 'Not given'
-
-        try:
-            phone = soup.find_all(
-                attrs={'data-qa-target': 'pdc-summary-new-patients-button'})[-1]['href'][4:]
-        except:
-            try:
-                phone = soup.find(
-                    attrs={'data-hgoname': 'summary-new-phone-number'})['href'][4:]
-            except:
-                phone = 'Not given'
-
-        try:
-            rating = float(soup.find(class_='score').find(
-                'strong').get_text(strip=True))
-        except:
-            rating = 'Not given'
-
-        try:
-            try:
-                ratingCount = int(
-                    soup.find(class_='review-pill').find('small').get_text(strip=True))
-            except AttributeError:
-                ratingCount = int(soup.find(
-                    class_='review-count').get_text(strip=True).replace('(', '').replace(')', ''))
-        except ValueError::
-            ratingCount = 0
-
-        try:
-            awards = soup.find(attrs={'data-qa-target': 'about-me-awards'}
-                               ).get_text(strip=True).replace('Awards', '', 1)
-        except AttributeError:
-            awards = 'Not given'
-
-        try:
-            raw_locations = soup.find_all('div', class_='office-title')
-            locations = ';'.join([location.get_text(
-                strip=True) for location in raw_locations]) if len(raw_locations) else 'Not given'
-        except AttributeError:
-            locations = 'Not given'
-
-        data = {
-            'Name': name,
-            'Gender': gender,
-            'Age': age,
-            'Phone': phone,
-            'Rating': rating,
-            'Rating count': ratingCount,
-            'URL': url,
-            'Locations': locations,
-            'Awards': awards,
-            'Biography': biography,
-        }
-        
-        # Write scraped data to the .csv file
-        with open('data.csv', 'a', newline='', encoding='utf-8') as f:
-            csv_writer = csv.DictWriter(f, fieldnames=['Name', 'Gender', 'Age', 'Phone', 'Rating',
-                                                       'Rating count', 'URL', 'Locations', 'Awards', 'Biography'], delimiter='\t')
-            csv_writer.writerow(data)
-        
-        # Increment scraped_count
-        scraped_count += 1
 
+# Function to parse an already downloaded profile page. Does no network
+# I/O; url is only recorded with the data, charset is the one the response
+# declared, if any. Raises on pages it cannot read.
+def parse(url, html, charset=None):
+    fields = PROFILE(html, charset)
+
+    biography = fields['biography']
+    if biography is not None:
+        name = biography.split(',')[0]
+    else:
+        logger.warning('Biograhy and name were not found %s', url)
+        biography = 'Not given'
+        name = 'Not given'
+
+    gender = fields['gender'] if fields['gender'] is not None else 'Not given'
+
+    age = fields['age'].replace('•\xa0Age', '') if fields['age'] is not None else 'Not given'
+
+    phone = fields['phone_button']
+    if phone is None:
+        phone = fields['phone_link']
+    phone = phone[4:] if phone is not None else 'Not given'
+
+    try:
+        rating = float(fields['rating'])
+    except (TypeError, ValueError):
+        rating = 'Not given'
+
+    # Pages with neither count element are skipped, as before
+    if fields['review_pill'] is not None:
+        count = fields['review_pill']
+    elif fields['review_count'] is not None:
+        count = fields['review_count'].replace('(', '').replace(')', '')
+    else:
+        raise AttributeError('No review count found %s' % url)
+    try:
+        ratingCount = int(count)
+    except ValueError:
+        ratingCount = 0
+
+    awards = fields['awards'].replace('Awards', '', 1) if fields['awards'] is not None else 'Not given'
+
+    locations = ';'.join(fields['locations']) if fields['locations'] else 'Not given'
+
+    data = {
+        'Name': name,
+        'Gender': gender,
+        'Age': age,
+        'Phone': phone,
+        'Rating': rating,
+        'Rating count': ratingCount,
+        'URL': url,
+        'Locations': locations,
+        'Awards': awards,
+        'Biography': biography,
+    }
+
+    # Records are written by the single writer stage in main
+    return data
+
+
+# Entry point for the pool processes. Returns (record or None, seconds spent,
+# failure type name or None) so the main process can keep the metrics.
+def parse_page(url, html, charset=None):
+    start = perf_counter()
+    try:
+        record, failure = parse(url, html, charset), None
     except Exception as e:
-        print(e)
+        record, failure = None, type(e).__name__
+    return record, perf_counter() - start, failure
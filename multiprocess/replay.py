@@ -0,0 +1,119 @@
+import argparse
+import asyncio
+import os
+import random
+from aiohttp import web
+from samples import listing_page, profile_page
+
+
+# Local stand-in for the site, so crawls can be measured without touching
+# it. Serves recorded pages from a directory laid out as
+#
+#   listing/<letter>-<page>.html
+#   profile/<last path segment of the profile URL>.html
+#
+# or, without a directory, synthetic pages from samples.py. Latency, server
+# errors and a concurrency limit past which requests get 429 can be set to
+# see how the crawler behaves under them.
+#
+#   python replay.py --port 8080 --latency 0.05 --error-rate 0.01
+#   python main.py --base-url http://127.0.0.1:8080
+
+
+class Replay(object):
+
+    def __init__(self, pages=None, pages_per_letter=5, profiles_per_page=40,
+                 latency=0.0, jitter=0.0, error_rate=0.0, max_concurrency=0, seed=0):
+        self.pages = pages
+        self.pages_per_letter = pages_per_letter
+        self.profiles_per_page = profiles_per_page
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_concurrency = max_concurrency
+        self.random = random.Random(seed)
+        self.in_flight = 0
+
+    def last_page(self, letter):
+        # Synthetic chains differ in length per letter, like the real site
+        return random.Random(letter).randint(1, self.pages_per_letter)
+
+    def _read(self, *parts):
+        path = os.path.join(self.pages, *parts)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    async def _serve(self, render):
+        self.in_flight += 1
+        try:
+            if self.max_concurrency and self.in_flight > self.max_concurrency:
+                return web.Response(status=429)
+            delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.random.random() < self.error_rate:
+                return web.Response(status=503)
+            return render()
+        finally:
+            self.in_flight -= 1
+
+    async def listing(self, request):
+        letter, page = request.match_info['letter'], int(request.match_info['page'])
+
+        def render():
+            if self.pages:
+                body = self._read('listing', '%s-%s.html' % (letter, page))
+            elif page <= self.last_page(letter):
+                body = listing_page(letter, page, self.profiles_per_page)
+            else:
+                body = None
+            # Past the end of a chain the site redirects away
+            if body is None:
+                raise web.HTTPFound('/')
+            return web.Response(body=body, content_type='text/html')
+        return await self._serve(render)
+
+    async def profile(self, request):
+        slug = request.match_info['slug']
+
+        def render():
+            body = self._read('profile', slug + '.html') if self.pages else profile_page(slug)
+            if body is None:
+                raise web.HTTPNotFound()
+            return web.Response(body=body, content_type='text/html')
+        return await self._serve(render)
+
+    async def index(self, request):
+        return web.Response(text='')
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/affiliated-physicians/{letter}-{page:\\d+}', self.listing)
+        app.router.add_get('/physician/{slug}', self.profile)
+        app.router.add_get('/', self.index)
+        return app
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Serve recorded or synthetic pages locally.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--pages', help='directory of recorded pages (default: synthetic)')
+    parser.add_argument('--pages-per-letter', type=int, default=5,
+                        help='longest synthetic listing chain')
+    parser.add_argument('--profiles-per-page', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- seconds around the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 responses')
+    parser.add_argument('--max-concurrency', type=int, default=0,
+                        help='requests in flight before answering 429 (0: no limit)')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    replay = Replay(args.pages, args.pages_per_letter, args.profiles_per_page, args.latency,
+                    args.jitter, args.error_rate, args.max_concurrency)
+    web.run_app(replay.app(), host=args.host, port=args.port, print=None)
@@ -0,0 +1,109 @@
+import random
+
+
+# Synthetic listing and profile pages shaped like the real site, for
+# benchmarks and local runs when no recorded pages are available
+
+
+LISTING = '''<!DOCTYPE html>
+<html><head><title>Affiliated physicians {letter}-{page}</title></head>
+<body><ul class="link-column">
+{items}
+</ul></body></html>'''
+
+LISTING_ITEM = '<li class="link-column__list"><a href="{href}">Dr. {name}</a> <span>{specialty}</span></li>'
+
+PROFILE = '''<!DOCTYPE html>
+<html><head>{meta}<title>{name}</title>
+<script>window.__STATE__ = {{"provider": "{name}"}};</script>
+<style>.score strong {{ font-weight: bold }}</style>
+</head>
+<body>
+<div class="header">
+  <h1 data-qa-target="premium-biography">{name}, {suffix}</h1>
+  <span data-qa-target="ProviderDisplayGender">{gender}</span>
+  <span data-qa-target="ProviderDisplayAge">{bullet}Age {age}</span>
+</div>
+<div class="summary">
+  {phones}
+  <div class="score"><strong>{rating}</strong> out of 5</div>
+  {count}
+</div>
+<section data-qa-target="about-me-awards"><h3>Awards</h3>{awards}</section>
+<div class="offices">
+{offices}
+</div>
+{filler}
+</body></html>'''
+
+FIRST = ['Anna', 'Brian', 'Carla', 'David', 'Elena', 'Farid', 'Grace', 'Hiro', 'Ines', 'Jonas',
+         'José', 'Zoë']
+LAST = ['Abbott', 'Baker', 'Chen', 'Diaz', 'Evans', 'Fischer', 'Garcia', 'Hughes', 'Ito', 'Jensen',
+        'Müller', 'Núñez']
+SPECIALTIES = ['Cardiology', 'Dermatology', 'Family Medicine', 'Neurology', 'Pediatrics']
+
+
+def profile_href(letter, page, i):
+    return '/physician/dr-{}-{}-{}-{}'.format(letter, page, i, 'x%04d' % (page * 100 + i))
+
+
+def listing_page(letter, page, per_page=40):
+    rng = random.Random('{}-{}'.format(letter, page))
+    items = [LISTING_ITEM.format(href=profile_href(letter, page, i),
+                                 name='{} {}'.format(rng.choice(FIRST), rng.choice(LAST)),
+                                 specialty=rng.choice(SPECIALTIES))
+             for i in range(per_page)]
+    return LISTING.format(letter=letter, page=page, items='\n'.join(items))
+
+
+def profile_page(seed, meta=''):
+    # Varies which optional blocks are present so every fallback in
+    # parse_funcs.parse is exercised. Some names are not ASCII, and the
+    # bullet before the age is sometimes a literal character rather than
+    # an entity.
+    rng = random.Random(seed)
+    name = 'Dr. {} {}'.format(rng.choice(FIRST), rng.choice(LAST))
+
+    phones = ''
+    kind = rng.randrange(4)
+    if kind < 2:
+        phones = ''.join('<a data-qa-target="pdc-summary-new-patients-button" href="tel:555{:07d}">Call</a>'
+                         .format(rng.randrange(10 ** 7)) for _ in range(kind + 1))
+    elif kind == 2:
+        phones = '<a data-hgoname="summary-new-phone-number" href="tel:555{:07d}">Call</a>'.format(
+            rng.randrange(10 ** 7))
+
+    kind = rng.randrange(4)
+    if kind == 0:
+        count = '<div class="review-pill"><small>{}</small> reviews</div>'.format(rng.randrange(500))
+    elif kind == 1:
+        count = '<span class="review-count">({})</span>'.format(rng.randrange(500))
+    elif kind == 2:
+        count = '<div class="review-pill"><small>n/a</small></div>'
+    else:
+        count = '<div class="review-pill extra"><small> {} </small></div>'.format(rng.randrange(500))
+
+    awards = ''.join('<p>Award {}</p>'.format(rng.randrange(100)) for _ in range(rng.randrange(3)))
+    offices = '\n'.join('<div class="office-title">Clinic {}</div>'.format(rng.randrange(1000))
+                        for _ in range(rng.randrange(4)))
+    filler = '\n'.join('<div class="block"><p>{}</p><ul>{}</ul></div>'.format(
+        'Lorem ipsum dolor sit amet ' * 8,
+        ''.join('<li><a href="#{0}">Item {0}</a></li>'.format(j) for j in range(10)))
+        for _ in range(rng.randrange(20, 60)))
+
+    return PROFILE.format(meta=meta, name=name, suffix=rng.choice(['MD', 'DO', 'NP']),
+                          gender=rng.choice(['Male', 'Female']),
+                          bullet=rng.choice(['&bull;&nbsp;', '\u2022\xa0']), age=rng.randrange(30, 75),
+                          phones=phones, rating='%.1f' % (rng.random() * 5), count=count,
+                          awards=awards, offices=offices, filler=filler)
+
+
+def profile_bytes(seed):
+    # A profile page as a server might send it: UTF-8 with or without a
+    # <meta charset>, or windows-1252 that declares itself. None of them
+    # come with an HTTP charset here.
+    encoding, meta = random.Random(-seed - 1).choice([
+        ('utf-8', ''), ('utf-8', '<meta charset="utf-8">'),
+        ('windows-1252', '<meta http-equiv="Content-Type" content="text/html; charset=windows-1252">'),
+    ])
+    return profile_page(seed, meta).encode(encoding)
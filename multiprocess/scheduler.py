@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from time import monotonic
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    # Caps the request rate at `rate` per second, allowing bursts of up to
+    # `burst` requests after an idle period
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.last = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveLimiter(object):
+    # Concurrency limit tuned by AIMD. Every `window` completed requests the
+    # limit grows by one, unless the window's error rate was above
+    # `max_error_rate` or its mean latency rose above `tolerance` times the
+    # best window seen so far; then it is multiplied by `decrease`. Latency
+    # under `latency_floor` seconds never counts as slow, so jitter on a
+    # fast link does not hold the limit down.
+
+    def __init__(self, initial, minimum=1, maximum=64, window=20,
+                 max_error_rate=0.05, tolerance=2.0, decrease=0.5, latency_floor=0.25):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.latency_floor = latency_floor
+        self.in_flight = 0
+        self.baseline = None
+        self._latencies = []
+        self._errors = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            while self.in_flight >= int(self.limit):
+                await self._cond.wait()
+            self.in_flight += 1
+
+    async def release(self, latency, ok):
+        async with self._cond:
+            self.in_flight -= 1
+            self._latencies.append(latency)
+            self._errors += not ok
+            if len(self._latencies) >= self.window:
+                self._adjust()
+            self._cond.notify_all()
+
+    def _adjust(self):
+        mean = sum(self._latencies) / len(self._latencies)
+        error_rate = self._errors / len(self._latencies)
+        self._latencies, self._errors = [], 0
+
+        if self.baseline is None or mean < self.baseline:
+            self.baseline = mean
+
+        previous = self.limit
+        slow = mean > max(self.baseline * self.tolerance, self.latency_floor)
+        if error_rate > self.max_error_rate or slow:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+
+        if int(previous) != int(self.limit):
+            logger.debug('Concurrency %s -> %s (latency %.3fs, errors %.0f%%)',
+                         int(previous), int(self.limit), mean, error_rate * 100)
+
+
+# Responses that mean the server wants us to slow down
+THROTTLED = (429, 503)
+
+
+class Scheduler(object):
+    # Every request of the crawl goes through one scheduler, so listing
+    # pages and profile pages share the same rate and concurrency budget
+
+    def __init__(self, rate, burst=None, initial=8, minimum=1, maximum=64, metrics=None,
+                 **limiter_options):
+        self.metrics = metrics
+        self.bucket = TokenBucket(rate, burst)
+        self.limiter = AdaptiveLimiter(initial, minimum, maximum, **limiter_options)
+        self.requests = 0
+        self.errors = 0
+
+    async def fetch(self, session, url, **kwargs):
+        # Returns (final url, status, body, charset from the Content-Type
+        # header or None). Server errors and throttling
+        # count against the limiter; exceptions are recorded and re-raised.
+        await self.limiter.acquire()
+        ok = False
+        start = monotonic()
+        try:
+            await self.bucket.acquire()
+            # Time spent waiting for a token is not server latency
+            start = monotonic()
+            async with session.get(url, **kwargs) as r:
+                body = await r.read()
+            ok = r.status < 500 and r.status not in THROTTLED
+            return str(r.url), r.status, body, r.charset
+        finally:
+            latency = monotonic() - start
+            self.requests += 1
+            self.errors += not ok
+            if self.metrics:
+                self.metrics.observe('request_seconds', latency)
+            await self.limiter.release(latency, ok)
+
+    def progress(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'concurrency': int(self.limiter.limit),
+            'in_flight': self.limiter.in_flight,
+        }
@@ -0,0 +1,151 @@
+import csv
+import logging
+import os
+
+
+FIELDNAMES = ['Name', 'Gender', 'Age', 'Phone', 'Rating',
+              'Rating count', 'URL', 'Locations', 'Awards', 'Biography']
+
+FORMATS = ('tsv', 'parquet', 'arrow')
+
+EXTENSIONS = {'tsv': 'csv', 'parquet': 'parquet', 'arrow': 'arrow'}
+
+
+logger = logging.getLogger(__name__)
+
+
+class Sink(object):
+    # Writes batches of records to path + '.part' and renames the finished
+    # file onto path in close(), so readers never see a half written output.
+    # Only one writer may own a sink.
+    #
+    # sync() and close() return the URLs whose records just became durable
+    # and, for formats that can be resumed mid-file, the byte offset they
+    # end at; a checkpoint marks exactly those profiles done.
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.part'
+        self.written = 0
+        self.offset = None
+        self.unsynced = []
+
+    def write_batch(self, records):
+        if records:
+            self._write(records)
+            self.written += len(records)
+            self.unsynced.extend(record['URL'] for record in records)
+
+    def _take(self):
+        urls, self.unsynced = self.unsynced, []
+        return urls
+
+    def sync(self):
+        # Nothing is durable before close by default
+        return [], None
+
+    def close(self):
+        self._close()
+        os.replace(self.tmp_path, self.path)
+        logger.info('Wrote %s records to %s', self.written, self.path)
+        return self._take(), self.offset
+
+
+class TsvSink(Sink):
+    # Resuming continues the previous run's file, cut back to the last
+    # offset the checkpoint saw synced so no record is written twice
+
+    def __init__(self, path, resume=False, offset=0):
+        super(TsvSink, self).__init__(path)
+        if resume:
+            if not os.path.exists(self.tmp_path) and os.path.exists(path):
+                os.replace(path, self.tmp_path)
+            self.f = open(self.tmp_path, 'a', newline='', encoding='utf-8')
+            self.f.truncate(min(offset, os.path.getsize(self.tmp_path)))
+            self.f.seek(0, os.SEEK_END)
+        else:
+            self.f = open(self.tmp_path, 'w', newline='', encoding='utf-8')
+        self.offset = self.f.tell()
+        self.writer = csv.DictWriter(self.f, fieldnames=FIELDNAMES, delimiter='\t')
+
+    def _write(self, records):
+        self.writer.writerows(records)
+        self.f.flush()
+
+    def sync(self):
+        os.fsync(self.f.fileno())
+        self.offset = self.f.tell()
+        return self._take(), self.offset
+
+    def _close(self):
+        self.offset = self.f.tell()
+        self.f.close()
+
+
+def _segment(path):
+    base, ext = os.path.splitext(path)
+    n = 0
+    while os.path.exists(path):
+        n += 1
+        path = '%s.%s%s' % (base, n, ext)
+    return path
+
+
+def _float(value):
+    return value if isinstance(value, (int, float)) else None
+
+
+def _int(value):
+    return value if isinstance(value, int) else None
+
+
+class ColumnarSink(Sink):
+    # Shared by the Parquet and Arrow IPC sinks. 'Not given' ratings become
+    # nulls so the numeric columns keep a real type. Their files are only
+    # readable once closed, so a resumed run writes the next free segment,
+    # e.g. data.1.parquet, next to the earlier finished ones.
+
+    def __init__(self, path, resume=False, offset=0):
+        if resume:
+            path = _segment(path)
+        super(ColumnarSink, self).__init__(path)
+        import pyarrow as pa
+        self.pa = pa
+        self.schema = pa.schema([(name, pa.string()) for name in FIELDNAMES])
+        self.schema = self.schema.set(FIELDNAMES.index('Rating'),
+                                      pa.field('Rating', pa.float64()))
+        self.schema = self.schema.set(FIELDNAMES.index('Rating count'),
+                                      pa.field('Rating count', pa.int64()))
+        self.converters = {'Rating': _float, 'Rating count': _int}
+        self.writer = self._open_writer()
+
+    def _write(self, records):
+        columns = {}
+        for name in FIELDNAMES:
+            convert = self.converters.get(name)
+            values = [record.get(name) for record in records]
+            columns[name] = [convert(v) for v in values] if convert else values
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+
+    def _close(self):
+        self.writer.close()
+
+
+class ParquetSink(ColumnarSink):
+
+    def _open_writer(self):
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(self.tmp_path, self.schema)
+
+
+class ArrowSink(ColumnarSink):
+
+    def _open_writer(self):
+        return self.pa.ipc.new_file(self.tmp_path, self.schema)
+
+
+def open_sink(path, fmt='tsv', resume=False, offset=0):
+    sinks = {'tsv': TsvSink, 'parquet': ParquetSink, 'arrow': ArrowSink}
+    if fmt not in sinks:
+        raise ValueError('Unknown output format: %s' % fmt)
+    return sinks[fmt](path, resume, offset)
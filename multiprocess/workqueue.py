@@ -0,0 +1,231 @@
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from time import time
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS ranges (
+    letter TEXT NOT NULL,
+    first INTEGER NOT NULL,
+    last INTEGER NOT NULL,
+    node TEXT,
+    lease_until REAL,
+    done INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (letter, first)
+);
+CREATE TABLE IF NOT EXISTS profiles (
+    url TEXT PRIMARY KEY,
+    node TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS profiles_node ON profiles (node, done);
+CREATE TABLE IF NOT EXISTS nodes (
+    node TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL,
+    offset INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+
+# Listing pages per leased range, and seconds a lease lasts without
+# renewal. A node that misses heartbeats for three lease periods is
+# presumed dead and its profiles are adopted.
+RANGE_SIZE = 10
+LEASE_TTL = 60
+
+# SQLite limits the number of bound parameters per statement
+CHUNK = 500
+
+
+def _chunks(items):
+    items = list(items)
+    for i in range(0, len(items), CHUNK):
+        yield items[i:i + CHUNK]
+
+
+class WorkQueue(object):
+    # Shared state of a crawl spread over several nodes, in one SQLite file.
+    # The file is opened in WAL mode, which coordinates through shared
+    # memory, so every node must run on the host that holds it; a network
+    # filesystem does not give nodes on other hosts a working lock.
+    #
+    # Listing pages are handed out as leased ranges of one letter's chain.
+    # Finishing a range before the chain ends queues the next range, so
+    # chains are followed without any node knowing their length; a range
+    # whose lease runs out is handed to another node.
+    #
+    # Each discovered profile is claimed by exactly one node, and a node
+    # only writes records for URLs it owns, so the per node output files
+    # never overlap. Claims a node left unwritten are adopted by others once
+    # it stops sending heartbeats. A dead node's file is valid up to its
+    # recorded offset; restarting it under the same name cuts it back there
+    # and frees the ranges it held, which its heartbeats would otherwise
+    # keep leased to it forever.
+    #
+    # Also serves as the main1 checkpoint in worker mode, so it is used from
+    # the event loop and from the writer's executor thread.
+
+    def __init__(self, path, node, range_size=RANGE_SIZE, lease_ttl=LEASE_TTL):
+        self.path = path
+        self.node = node
+        self.range_size = range_size
+        self.lease_ttl = lease_ttl
+        self.node_ttl = lease_ttl * 3
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        self.resumed = self._one('SELECT COUNT(*) FROM nodes WHERE node = ?', (node,)) > 0
+        if self.resumed:
+            self.release_all()
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two nodes can
+        # never lease the same range
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            else:
+                self.conn.execute('COMMIT')
+
+    def _one(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()[0]
+
+    def seed(self, letters):
+        with self._transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO ranges (letter, first, last) VALUES (?, 1, ?)',
+                             ((letter, self.range_size) for letter in letters))
+
+    def heartbeat(self):
+        # Renews this node's leases, and marks it alive
+        now = time()
+        with self._transaction() as conn:
+            conn.execute('INSERT INTO nodes (node, heartbeat) VALUES (?, ?) '
+                         'ON CONFLICT (node) DO UPDATE SET heartbeat = excluded.heartbeat',
+                         (self.node, now))
+            conn.execute('UPDATE ranges SET lease_until = ? WHERE node = ? AND done = 0',
+                         (now + self.lease_ttl, self.node))
+
+    def lease(self):
+        # (letter, first page, last page), or None when nothing is free
+        now = time()
+        with self._transaction() as conn:
+            row = conn.execute('SELECT letter, first, last FROM ranges '
+                               'WHERE done = 0 AND (node IS NULL OR lease_until < ?) '
+                               'ORDER BY first, letter LIMIT 1', (now,)).fetchone()
+            if row:
+                conn.execute('UPDATE ranges SET node = ?, lease_until = ? WHERE letter = ? AND first = ?',
+                             (self.node, now + self.lease_ttl, row[0], row[1]))
+        return row
+
+    def complete(self, letter, first, last, reached_end):
+        # A node that lost the lease meanwhile changes nothing; the range's
+        # new holder completes it
+        with self._transaction() as conn:
+            updated = conn.execute('UPDATE ranges SET done = 1 '
+                                   'WHERE letter = ? AND first = ? AND node = ? AND done = 0',
+                                   (letter, first, self.node)).rowcount
+            if updated and not reached_end:
+                conn.execute('INSERT OR IGNORE INTO ranges (letter, first, last) VALUES (?, ?, ?)',
+                             (letter, last + 1, last + self.range_size))
+
+    def release(self, letter, first):
+        with self._transaction() as conn:
+            conn.execute('UPDATE ranges SET node = NULL, lease_until = NULL '
+                         'WHERE letter = ? AND first = ? AND node = ?', (letter, first, self.node))
+
+    def release_all(self):
+        # Frees this node's unfinished ranges, e.g. those a previous run
+        # under the same name was crawling when it stopped
+        with self._transaction() as conn:
+            released = conn.execute('UPDATE ranges SET node = NULL, lease_until = NULL '
+                                    'WHERE node = ? AND done = 0', (self.node,)).rowcount
+        if released:
+            logger.debug('%s released %s ranges', self.node, released)
+
+    def page_done(self, letter, page, urls):
+        # Claims the page's profiles; returns the ones this node should fetch
+        with self._transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO profiles (url, node) VALUES (?, ?)',
+                             ((url, self.node) for url in urls))
+        owned = self.owned(urls)
+        return [url for url in urls if url in owned]
+
+    def letter_done(self, letter):
+        # The end of a chain is recorded by complete()
+        pass
+
+    def owned(self, urls):
+        # URLs this node owns and has not written yet
+        owned = set()
+        with self.lock:
+            for chunk in _chunks(urls):
+                owned.update(row[0] for row in self.conn.execute(
+                    'SELECT url FROM profiles WHERE node = ? AND done = 0 AND url IN (%s)'
+                    % ','.join('?' * len(chunk)), [self.node] + chunk))
+        return owned
+
+    def adopt(self, include_own=False):
+        # Takes over the unwritten profiles of nodes that stopped sending
+        # heartbeats; on restart also returns this node's own leftovers
+        dead = time() - self.node_ttl
+        where = 'done = 0 AND node IN (SELECT node FROM nodes WHERE heartbeat < ? AND node != ?)'
+        with self._transaction() as conn:
+            urls = []
+            if include_own:
+                urls = [row[0] for row in conn.execute(
+                    'SELECT url FROM profiles WHERE node = ? AND done = 0', (self.node,))]
+            urls += [row[0] for row in conn.execute('SELECT url FROM profiles WHERE ' + where,
+                                                    (dead, self.node))]
+            conn.execute('UPDATE profiles SET node = ? WHERE ' + where, (self.node, dead, self.node))
+        if urls:
+            logger.debug('%s adopted %s profiles', self.node, len(urls))
+        return urls
+
+    @property
+    def offset(self):
+        # Bytes of this node's TSV output that are covered by done profiles
+        return self._one('SELECT COALESCE(MAX(offset), 0) FROM nodes WHERE node = ?', (self.node,))
+
+    def profiles_done(self, urls, offset=None):
+        with self._transaction() as conn:
+            conn.executemany('UPDATE profiles SET done = 1 WHERE url = ? AND node = ?',
+                             ((url, self.node) for url in urls))
+            if offset is not None:
+                conn.execute('UPDATE nodes SET offset = ? WHERE node = ?', (offset, self.node))
+
+    def finished(self):
+        # Every range is done and no dead node holds unwritten profiles.
+        # Live nodes finish their own.
+        ranges = self._one('SELECT COUNT(*) FROM ranges')
+        open_ranges = self._one('SELECT COUNT(*) FROM ranges WHERE done = 0')
+        orphans = self._one('SELECT COUNT(*) FROM profiles WHERE done = 0 AND node IN '
+                            '(SELECT node FROM nodes WHERE heartbeat < ? AND node != ?)',
+                            (time() - self.node_ttl, self.node))
+        return ranges > 0 and open_ranges == 0 and orphans == 0
+
+    def progress(self):
+        return {
+            'ranges': self._one('SELECT COUNT(*) FROM ranges'),
+            'ranges_done': self._one('SELECT COUNT(*) FROM ranges WHERE done = 1'),
+            'profiles': self._one('SELECT COUNT(*) FROM profiles'),
+            'profiles_done': self._one('SELECT COUNT(*) FROM profiles WHERE done = 1'),
+            'nodes': self._one('SELECT COUNT(*) FROM nodes WHERE heartbeat >= ?',
+                               (time() - self.node_ttl,)),
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,283 @@
+import argparse
+import math
+import random
+import multiprocessing
+import multiprocessing.forkserver
+import resource
+import sys
+import threading
+from timeit import default_timer
+from patternparser import *
+from example_brackets import S
+from example_LL_RL import LL, RL
+from example_term import Digit, Term
+
+# Parses generated inputs of growing size with the example grammars and
+# reports, per size, the best time, the memo entries left at the end and
+# how much a parse raised the peak resident set:
+#
+#   python benchmark.py
+#   python benchmark.py --grammars Term S --sizes 1000 10000 50000
+#   python benchmark.py --compare       also time the grammars written with expand()
+#   python benchmark.py --profile       per rule counts for the largest size
+#   python benchmark.py --check         feed IncrementalParser random chunks
+#
+# The exponent is the slope of time against size on a log-log scale: about
+# 1 for linear parsing, 2 for quadratic. The run fails when the slope from
+# the smallest to the largest size exceeds --max-exponent. Memory is not
+# checked: RL and S keep a string per memo entry as long as the input it
+# covers, so theirs grows quadratically whatever the parser does.
+#
+# Right recursion and nested seeds recurse once per character, so parses
+# run on a thread with a large stack. Each grammar's report ends with the
+# input size at which Python's default recursion limit, on a main thread
+# stack, stops being enough.
+
+def expanded():
+    # The same grammars written with expand(), which rebuilds a rule's
+    # alternatives on every application
+    def LL(x):
+        return expand(LL,x)((
+            (concat(LL, sym('a')) ,                 lambda t : t[0] + 'b'),
+            (sym('a') ,                             lambda a : 'b'),
+            ))
+
+    def RL(x):
+        return expand(RL,x)((
+            (concat(sym('a'), RL) ,                 lambda t : 'b' + t[1]),
+            (sym('a') ,                             lambda a : 'b'),
+            ))
+
+    def S(x):
+        return expand(S,x)((
+            (concat(S, S) ,                         lambda t : t[0] + t[1]),
+            (concat(sym('('), S, sym(')')),         lambda t : '<' + t[1] + '>'),
+            (concat(sym('('), sym(')')),            lambda t : '<>'),
+            ))
+
+    def Term(x):
+        return expand(Term,x)((
+            (concat(Brack, sym('+'), Brack) ,       lambda t : t[0] + t[2]),
+            (concat(Brack, sym('-'), Brack) ,       lambda t : t[0] - t[2]),
+            (concat(Brack, sym('*'), Brack) ,       lambda t : t[0] * t[2]),
+            (concat(Brack, sym('/'), Brack) ,       lambda t : t[0] // t[2]),
+            (Number,                                identity),
+            ))
+
+    def Brack(x):
+        return expand(Brack,x)((
+            (concat(sym('('), Term, sym(')')) ,     lambda t : t[1]),
+            (Number,                                identity),
+            ))
+
+    def Number(x):
+        return expand(Number,x)((
+            (concat(Number, Digit) ,                lambda t : (t[0] * 10) + t[1]),
+            (Digit,                                 identity),
+            ))
+
+    return {'LL': LL, 'RL': RL, 'S': S, 'Term': Term}
+
+def term_input(n):
+    # Nested brackets around long numbers, so Term, Brack and Number all
+    # recurse: 12345678*(90123456-(78901234*(...)))
+    digits = '1234567890' * (n // 10 + 1)
+    (parts, i) = ([], 0)
+    while i < n - 12:
+        parts.append(digits[i % 10:i % 10 + 8])
+        i += 11
+    text = parts.pop()
+    for (k, part) in enumerate(reversed(parts)):
+        text = part + '-*+'[k % 3] + '(' + text + ')'
+    return text
+
+# name -> (rule, input of about n characters); every input parses whole
+GRAMMARS = {
+    'LL': (LL, lambda n: 'a' * n),
+    'RL': (RL, lambda n: 'a' * n),
+    'S': (S, lambda n: '(()())' * (n // 6) + '()'),
+    'Term': (Term, term_input),
+}
+
+def parse(rule, text):
+    parser = Parser()
+    (p, r) = parser.parse(rule, Text(text))
+    if p is None or r:
+        raise ValueError('%s did not parse the whole input' % rule.__name__)
+    return parser
+
+def measure(rule, text, repeat):
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        parser = parse(rule, text)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, len(parser.cache))
+
+def _peak_rss(conn, name, text, stack_mib):
+    sys.setrecursionlimit(10 ** 7)
+    threading.stack_size(stack_mib * 2 ** 20)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    thread = threading.Thread(target=parse, args=(GRAMMARS[name][0], text))
+    thread.start()
+    thread.join()
+    conn.send(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+def peak_memory(name, text, stack_mib):
+    # In a child of the fork server, which is started before any parse, so
+    # the peak starts from a small process rather than one holding memory
+    # earlier parses freed. tracemalloc would avoid the process but slows
+    # parsing down more the deeper it recurses, quadratically for RL and S.
+    server = multiprocessing.get_context('forkserver')
+    (receiver, sender) = server.Pipe(False)
+    child = server.Process(target=_peak_rss, args=(sender, name, text, stack_mib))
+    child.start()
+    peak = receiver.recv()
+    child.join()
+    # ru_maxrss is in KiB on Linux
+    return peak * 1024
+
+def _fits_defaults(conn, name, n):
+    # In a fork server child, which keeps the default recursion limit
+    (rule, make) = GRAMMARS[name]
+    try:
+        parse(rule, make(n))
+        conn.send(True)
+    except RecursionError:
+        conn.send(False)
+
+def fits_defaults(name, n):
+    server = multiprocessing.get_context('forkserver')
+    (receiver, sender) = server.Pipe(False)
+    child = server.Process(target=_fits_defaults, args=(sender, name, n))
+    child.start()
+    fits = receiver.recv()
+    child.join()
+    return fits
+
+def default_limit(name, largest):
+    # Smallest size, to within 5%, that raises RecursionError with the
+    # default settings, or None if `largest` parses
+    if fits_defaults(name, largest):
+        return None
+    (good, bad) = (0, 100)
+    while bad < largest and fits_defaults(name, bad):
+        (good, bad) = (bad, bad * 2)
+    bad = min(bad, largest)
+    while bad - good > max(bad // 20, 1):
+        middle = (good + bad) // 2
+        if fits_defaults(name, middle):
+            good = middle
+        else:
+            bad = middle
+    return bad
+
+def exponent(smaller, larger):
+    (n1, t1), (n2, t2) = smaller, larger
+    return math.log(t2 / t1) / math.log(float(n2) / n1)
+
+def run(args, failures):
+    legacy = expanded() if args.compare else None
+    print('%-5s %8s %10s %9s %9s %10s %9s%s' % (
+        'rule', 'chars', 'seconds', 'us/char', 'memo', 'peak MiB', 'exponent',
+        '  expand s  speedup' if legacy else ''))
+    for name in args.grammars:
+        (rule, make) = GRAMMARS[name]
+        timings = []
+        for n in args.sizes:
+            text = make(n)
+            (seconds, memo) = measure(rule, text, args.repeat)
+            peak = peak_memory(name, text, args.stack_mib)
+            slope = '%.2f' % exponent(timings[-1], (len(text), seconds)) if timings else ''
+            timings.append((len(text), seconds))
+            row = '%-5s %8d %10.4f %9.2f %9d %10.1f %9s' % (
+                name, len(text), seconds, seconds / len(text) * 1e6, memo, peak / 2.0 ** 20, slope)
+            if legacy:
+                (before, _) = measure(legacy[name], text, args.repeat)
+                row += '  %8.4f %8.2f' % (before, before / seconds)
+            print(row)
+        if len(timings) > 1 and exponent(timings[0], timings[-1]) > args.max_exponent:
+            failures.append('%s: time grows as n^%.2f' % (name, exponent(timings[0], timings[-1])))
+        limit = default_limit(name, args.sizes[-1])
+        print('  default recursion limit: %s' % (
+            'enough up to %d chars' % args.sizes[-1] if limit is None
+            else 'RecursionError from about %d chars' % len(make(limit))))
+        if args.profile:
+            report_profile(rule, make(args.sizes[-1]))
+
+def report_profile(rule, text):
+    with profiling() as profile:
+        parse(rule, text)
+    print('  %-8s %9s %9s %9s %12s' % ('rule', 'calls', 'hits', 'misses', 'evaluations'))
+    for row in profile.summary():
+        print('  %-8s %9d %9d %9d %12d' % row)
+
+# (rule, skip, stream) for --check; the last items do not parse
+STREAMS = [
+    (LL, ' ', 'aaa a aaaa'),
+    (RL, ' ', 'aa aaa a'),
+    (S, ' ', '(()) ()(()) ((()))()'),
+    (S, '', '(()())(())()'),
+    (Term, ' ', '1+2 (3*4)-5 12345 (1+(2*3))*2 7'),
+    (Term, '\n', '1+2\n(3*4)-5\n+\n6'),
+    (Term, ' ', '12 (1+2'),
+]
+
+def incremental(rule, skip, chunks):
+    # (items, position of the ParseError or None), collected the way a
+    # caller would: items from every feed and from the error at close
+    stream = IncrementalParser(rule, skip)
+    items = []
+    try:
+        for chunk in chunks:
+            items += stream.feed(chunk)
+        items += stream.close()
+    except ParseError as e:
+        return (items + e.results, e.position)
+    return (items, None)
+
+def check_incremental(rounds):
+    # Every way of chunking a stream must give what feeding it whole does
+    failures = []
+    rng = random.Random(0)
+    for (rule, skip, text) in STREAMS:
+        expected = incremental(rule, skip, [text])
+        for _ in range(rounds):
+            (cuts, i) = ([], 0)
+            while i < len(text):
+                n = rng.randint(0, 4)
+                cuts.append(text[i:i + n])
+                i += n
+            got = incremental(rule, skip, cuts)
+            if got != expected:
+                failures.append('%s %r in %r: %r, expected %r' % (rule, text, cuts, got, expected))
+                break
+    print('incremental: %d streams, %d chunkings each, %d failed' % (
+        len(STREAMS), rounds, len(failures)))
+    return failures
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Benchmark patternparser on the example grammars.')
+    parser.add_argument('--grammars', nargs='+', choices=sorted(GRAMMARS), default=sorted(GRAMMARS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 2000, 4000, 8000, 16000])
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size; the best is reported')
+    parser.add_argument('--max-exponent', type=float, default=1.5)
+    parser.add_argument('--compare', action='store_true', help='also time the expand() grammars')
+    parser.add_argument('--profile', action='store_true', help='count rule applications')
+    parser.add_argument('--stack-mib', type=int, default=512)
+    parser.add_argument('--check', type=int, nargs='?', const=300, default=0, metavar='ROUNDS',
+                        help='compare random chunkings with whole-input IncrementalParser runs')
+    return parser
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    multiprocessing.forkserver.ensure_running()
+    sys.setrecursionlimit(10 ** 7)
+    threading.stack_size(args.stack_mib * 2 ** 20)
+    failures = check_incremental(args.check) if args.check else []
+    thread = threading.Thread(target=run, args=(args, failures))
+    thread.start()
+    thread.join()
+    if failures:
+        raise SystemExit('\n'.join(failures))
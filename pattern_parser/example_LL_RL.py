@@ -1,21 +1,22 @@
 from patternparser import *
 
-def RL(x):
-    return expand(RL,x)((
-        (concat(sym('a'), RL) ,   lambda (s1,s2) : 'b' + s2),
+@rule
+def RL():
+    return (
+        (concat(sym('a'), RL) ,   lambda t : 'b' + t[1]),
         (sym('a') ,              lambda a : 'b'),
-        ))
+        )
 
 
-def LL(x):
-    return expand(LL,x)((
-        (concat(LL, sym('a')) ,   lambda (s1,s2) : s1 + 'b'),
+@rule
+def LL():
+    return (
+        (concat(LL, sym('a')) ,   lambda t : t[0] + 'b'),
         (sym('a') ,              lambda a : 'b'),
-        ))
-    
-            
-    
-print RL('aaaaaa')
+        )
 
 
-print LL('aaaaaa')
\ No newline at end of file
+if __name__ == '__main__':
+    print(RL('aaaaaa'))
+
+    print(LL('aaaaaa'))
@@ -1,10 +1,12 @@
 from patternparser import *
-    
-def S(x):
-    return expand(S,x)((
-        (concat(S, S) ,                     lambda (s1,s2) : s1 + s2),
-        (concat(sym('('), S, sym(')')),     lambda (l,s,r) : '<' + s + '>'),
-        (concat(sym('('), sym(')')),        lambda x : '<>'),
-        ))
 
-print S('(()())()')
\ No newline at end of file
+@rule
+def S():
+    return (
+        (concat(S, S) ,                     lambda t : t[0] + t[1]),
+        (concat(sym('('), S, sym(')')),     lambda t : '<' + t[1] + '>'),
+        (concat(sym('('), sym(')')),        lambda t : '<>'),
+        )
+
+if __name__ == '__main__':
+    print(S('(()())()'))
@@ -1,37 +1,48 @@
 from patternparser import *
 
-def Term(x):
-    return expand(Term,x)((
-        (concat(Brack, sym('+'), Brack) ,       lambda (l,o,r) : l + r ),
-        (concat(Brack, sym('-'), Brack) ,       lambda (l,o,r) : l - r ),
-        (concat(Brack, sym('*'), Brack) ,       lambda (l,o,r) : l * r ),
-        (concat(Brack, sym('/'), Brack) ,       lambda (l,o,r) : l / r ),
+@rule
+def Term():
+    return (
+        (concat(Brack, sym('+'), Brack) ,       lambda t : t[0] + t[2] ),
+        (concat(Brack, sym('-'), Brack) ,       lambda t : t[0] - t[2] ),
+        (concat(Brack, sym('*'), Brack) ,       lambda t : t[0] * t[2] ),
+        (concat(Brack, sym('/'), Brack) ,       lambda t : t[0] // t[2] ),
         (Number,                                identity),
-        ))   
-        
-def Brack(x):
-    return expand(Brack,x)((
-        (concat(sym('('), Term, sym(')')) ,     lambda (l,o,r) : o),
+        )
+
+@rule
+def Brack():
+    return (
+        (concat(sym('('), Term, sym(')')) ,     lambda t : t[1]),
         (Number,                                identity),
-        ))           
+        )
 
-def Number(x):
-    return expand(Number,x)((
-        (concat(Number, Digit) ,                lambda (n, d) : (n * 10) + d),
+@rule
+def Number():
+    return (
+        (concat(Number, Digit) ,                lambda t : (t[0] * 10) + t[1]),
         (Digit,                                 identity),
-        ))   
-   
+        )
+
+@inline
 def Digit(x):
     if x and x[0] in '0123456789':
-        res = (ord(x[0])-ord('0'), x[1:])
-        cacheit((Digit, x), res)
-        return res
-    return (None, x)   
+        return (ord(x[0])-ord('0'), x[1:])
+    return (None, x)
 
 
 def evaluate_and_print(expression):
-    print expression + ' = ' + str(Term(expression))
-    
-evaluate_and_print('1300+37') 
-  
-evaluate_and_print('(2+3)*(1+4)')  
\ No newline at end of file
+    print(expression + ' = ' + str(Term(expression)))
+
+if __name__ == '__main__':
+    evaluate_and_print('1300+37')
+
+    evaluate_and_print('(2+3)*(1+4)')
+
+    # One expression per line, printed as soon as its line is complete
+    stream = IncrementalParser(Term, skip='\n')
+    for chunk in ('1300+3', '7\n(2+3)*', '(1+4)\n42', '/6\n'):
+        for value in stream.feed(chunk):
+            print(value)
+    for value in stream.close():
+        print(value)
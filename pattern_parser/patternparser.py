@@ -1,75 +1,549 @@
-cache = {}
-blacklist = set()
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+_local = threading.local()
+
+class Parser(object):
+    # Memo table for a single parse. The outermost rule call creates one
+    # and drops it when it returns; the nested calls it makes on the same
+    # thread share it. Other threads never see it.
+    #
+    # Parsing time is linear, but rules run on the Python stack, about five
+    # frames per nested application. Left recursion grows in a loop, so LL
+    # on 'aaa...' stays shallow, but right recursion (RL) and a left
+    # recursion whose growth applies the rule again further on (S on
+    # '()()()...', where every item starts a growth of its own) nest one
+    # level per item. Under the default recursion limit of 1000 that is a
+    # couple of hundred items; beyond it raise sys.setrecursionlimit() and
+    # parse on a thread with a larger stack (threading.stack_size()), as
+    # benchmark.py does, which also reports where the defaults give out.
+
+    def __init__(self):
+        self.reset()
+        self.profile = getattr(_local, 'profile', None)
+
+    def reset(self):
+        self.cache = {}
+        # Left recursion being grown at each position, the innermost rule
+        # application being evaluated, and the rule whose body applyrule
+        # is about to run
+        self.heads = {}
+        self.lrstack = None
+        self.body = None
+        # One past the furthest position a Stream parse has read, and when
+        # tracking, the same per memo entry and the furthest grown left
+        # recursions that read no further than the input then ended
+        self.reach = 0
+        self.reaches = None
+        self.resume = None
+
+    def track(self):
+        # Records reach per memo entry, so that invalidate() can keep the
+        # entries that still hold once more input arrives
+        self.reaches = {}
+        self.resume = {}
+
+    def invalidate(self, end):
+        # Drops the entries that read past end, i.e. looked for input that
+        # had not arrived yet; returns how many
+        (cache, reaches) = (self.cache, self.reaches)
+        stale = [k for k in cache if reaches.get(k, end + 1) > end]
+        for k in stale:
+            del cache[k]
+            reaches.pop(k, None)
+        return len(stale)
+
+    def forget(self, pos):
+        # Drops every entry for a position before pos
+        for table in (self.cache, self.reaches, self.resume):
+            for k in [k for k in table if k[1] < pos]:
+                del table[k]
+
+    def parse(self, f, x):
+        # Applies rule f to x, a str or a Text, starting from an empty memo
+        # table. For a str the remainder comes back as a str.
+        self.reset()
+        if isinstance(x, Text):
+            return self.apply(f, x)
+        (p, r) = self.apply(f, Text(x))
+        return (p, str(r))
+
+    def apply(self, f, x):
+        # Memoized application of f to the Text x, keeping whatever the
+        # memo table already holds
+        previous = current()
+        _local.parser = self
+        try:
+            return applyrule(f, x)
+        finally:
+            _local.parser = previous
+
+def current():
+    return getattr(_local, 'parser', None)
+
+class Profile(object):
+    # Per rule counts for the parses run under profiling(): applications,
+    # how many the memo answered (hits, including left recursion seeds) or
+    # not (misses), and evaluations of the rule's alternatives, which
+    # exceed misses by the passes spent growing left recursion
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.evaluations = defaultdict(int)
+
+    def summary(self):
+        # (rule name, calls, hits, misses, evaluations), most called first
+        rows = [(getattr(f, '__name__', repr(f)), n, self.hits[f], self.misses[f],
+                 self.evaluations[f]) for (f, n) in self.calls.items()]
+        return sorted(rows, key=lambda row: -row[1])
+
+@contextmanager
+def profiling(profile=None):
+    # Parses started on this thread inside the block count into profile
+    profile = profile if profile is not None else Profile()
+    previous = getattr(_local, 'profile', None)
+    _local.profile = profile
+    try:
+        yield profile
+    finally:
+        _local.profile = previous
+
+class Text(object):
+    # Read-only view of the input from pos on. Rules use the remaining input
+    # through x[0], x[1:], len() and truth, which all work on the view
+    # without copying, so stepping forward is O(1) and the memo table can be
+    # keyed on (rule, pos) instead of hashing suffix strings.
+    __slots__ = ('source', 'pos')
+
+    def __init__(self, source, pos=0):
+        self.source = source
+        self.pos = pos
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            if i.stop is None and i.step is None and (i.start or 0) >= 0:
+                return Text(self.source, min(self.pos + (i.start or 0), len(self.source)))
+            return self.source[self.pos:][i]
+        if i < 0:
+            i += len(self)
+            if i < 0:
+                raise IndexError('Text index out of range')
+        return self.source[self.pos + i]
+
+    def __len__(self):
+        return len(self.source) - self.pos
+
+    def __bool__(self):
+        return self.pos < len(self.source)
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if isinstance(other, Text):
+            return self.pos == other.pos and self.source is other.source
+        return str(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pos)
+
+    def __str__(self):
+        return self.source[self.pos:]
+
+    def __repr__(self):
+        return 'Text(%r, %d)' % (self.source, self.pos)
+
+class Stream(Text):
+    # Text of an input that may go on past the end of source. Every read
+    # moves the parser's reach, so IncrementalParser can tell whether a
+    # result depended on where the input seen so far happens to end.
+    __slots__ = ()
+
+    def touch(self, end):
+        parser = current()
+        if end > parser.reach:
+            parser.reach = end
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            if i.stop is None and i.step is None and (i.start or 0) >= 0:
+                return Stream(self.source, min(self.pos + (i.start or 0), len(self.source)))
+            self.touch(len(self.source) + 1)
+        elif i < 0:
+            self.touch(len(self.source) + 1)
+        else:
+            self.touch(self.pos + i + 1)
+        return Text.__getitem__(self, i)
+
+    def __len__(self):
+        self.touch(len(self.source) + 1)
+        return Text.__len__(self)
+
+    def __bool__(self):
+        self.touch(self.pos + 1)
+        return Text.__bool__(self)
+
+    __nonzero__ = __bool__
+
+def inline(f):
+    # Marks a pattern that concat calls directly rather than as a memoized
+    # rule application: terminals, and sequences whose parts are memoized
+    # themselves
+    f.inline = True
+    return f
 
 def concat(*args):
+    steps = tuple((f, getattr(f, 'inline', False)) for f in args)
+    @inline
     def _concats(x):
         r = x
         result = ()
-        for f in args:
-            c = getfromcache(f, r)
-            if c == resolving:
-                return (None, x)
-            (p,r) = c    
+        for (f, direct) in steps:
+            (p,r) = f(r) if direct else applyrule(f, r)
             if p is None:
                 return (None, x)
             result += (p,)
-        return (result, r) 
+        return (result, r)
     return _concats
-        
+
 def sym(c):
+    @inline
     def _symbol(x):
         if x and x[0] == c:
-            cacheit((sym, c, x), (c, x[1:]))
             return (c, x[1:])
         return (None, x)
     return _symbol
 
 def cacheit(k,v):
-    if (k,v) in blacklist:
-        return False
-    blacklist.add((k,v))
-    cache[k] = v
+    # applyrule memoizes every result now; kept so rules that still call
+    # it keep working
     return True
 
-def resolving():
-    pass
-
-def cachedordefault(f, x, default):
-    if (f,x) in cache and not cache[(f,x)] == resolving:
-        return cache[(f,x)]
-    else:
-        return default
-    
-def getfromcache(f, x):
-    if (f,x) in cache:
-        return cache[(f,x)]
-    else:
-        cache[(f,x)] = resolving
-        return f(x)
+# Left recursion is handled by growing a seed, as in Warth, Douglass and
+# Millstein, "Packrat Parsers Can Support Left Recursion" (2008). The
+# first application of a rule at a position is memoized as a failing
+# LeftRecursion; if the rule reaches itself again there, the rules on the
+# way become involved in a Head for that position, and once the seed
+# parse returns the rule is re-evaluated, each pass building on the
+# previous result, until it stops consuming more input.
 
-def rules(f, x, args):
-    def cacheandcall(v):
-        if cacheit((f,x), v):
-            return f(x)
+class LeftRecursion(object):
+    __slots__ = ('seed', 'rule', 'head', 'next')
+
+    def __init__(self, seed, rule, next):
+        self.seed = seed
+        self.rule = rule
+        self.head = None
+        self.next = next
+
+class Head(object):
+    __slots__ = ('rule', 'involved', 'eval')
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.involved = set()
+        self.eval = set()
+
+def evaluate(parser, f, x):
+    if parser.profile is not None:
+        parser.profile.evaluations[f] += 1
+    parser.body = f
+    return f(x)
+
+def applyrule(f, x):
+    parser = current()
+    m = recall(parser, f, x)
+    if parser.profile is not None:
+        parser.profile.calls[f] += 1
+        if m is None:
+            parser.profile.misses[f] += 1
         else:
-            return cache[(f,x)]    
-    
-    def match(pattern, semantics):
-        (p,r) = pattern(x)
-        if p is not None:
-            return cacheandcall((semantics(p), r))
+            parser.profile.hits[f] += 1
+    reaches = parser.reaches
+    if m is None:
+        if reaches is not None:
+            outer = parser.reach
+            parser.reach = 0
+        lr = LeftRecursion((None, x), f, parser.lrstack)
+        parser.lrstack = lr
+        parser.cache[(f, x.pos)] = lr
+        ans = evaluate(parser, f, x)
+        parser.lrstack = lr.next
+        if lr.head is not None:
+            lr.seed = ans
+            ans = lranswer(parser, f, x, lr)
         else:
-            return None
-        
+            parser.cache[(f, x.pos)] = ans
+        if reaches is not None:
+            reaches[(f, x.pos)] = parser.reach
+            if lr.head is not None and lr.head.rule is f:
+                # The involved rules' entries here were built on seeds of
+                # this application, so they rest on everything it read
+                for g in lr.head.involved:
+                    reaches[(g, x.pos)] = parser.reach
+            parser.reach = max(outer, parser.reach)
+        return ans
+    if reaches is not None and parser.reach < reaches.get((f, x.pos), 0):
+        parser.reach = reaches[(f, x.pos)]
+    if isinstance(m, LeftRecursion):
+        setuplr(parser, f, m)
+        return m.seed
+    return m
+
+def recall(parser, f, x):
+    m = parser.cache.get((f, x.pos))
+    h = parser.heads.get(x.pos)
+    if h is None:
+        return m
+    # While a left recursion grows here, rules outside it must not start
+    # parses of their own that would see its half grown result
+    if m is None and f is not h.rule and f not in h.involved:
+        return (None, x)
+    if f in h.eval:
+        h.eval.discard(f)
+        m = parser.cache[(f, x.pos)] = evaluate(parser, f, x)
+    return m
+
+def setuplr(parser, f, lr):
+    if lr.head is None:
+        lr.head = Head(f)
+    s = parser.lrstack
+    while s.head is not lr.head:
+        s.head = lr.head
+        lr.head.involved.add(s.rule)
+        s = s.next
+
+def lranswer(parser, f, x, lr):
+    if lr.head.rule is not f:
+        return lr.seed
+    parser.cache[(f, x.pos)] = lr.seed
+    if lr.seed[0] is None:
+        return lr.seed
+    return growlr(parser, f, x, lr.head)
+
+def growlr(parser, f, x, head):
+    k = (f, x.pos)
+    parser.heads[x.pos] = head
+    resume = parser.resume
+    if resume is not None and k in resume:
+        # Growing went this far before without reading past the input, and
+        # would again, so carry on from there
+        (ans, reach) = resume[k]
+        if ans[1].pos > parser.cache[k][1].pos:
+            parser.cache[k] = ans
+            parser.reach = max(parser.reach, reach)
+    while True:
+        head.eval = set(head.involved)
+        ans = evaluate(parser, f, x)
+        if ans[0] is None or ans[1].pos <= parser.cache[k][1].pos:
+            break
+        parser.cache[k] = ans
+        if resume is not None and parser.reach <= len(x.source):
+            resume[k] = (ans, parser.reach)
+    del parser.heads[x.pos]
+    return parser.cache[k]
+
+def toplevel(f, x):
+    # Outermost call: parse a view of the input and hand back the remainder
+    # as a plain string
+    (p, r) = Parser().parse(f, x)
+    return (p, str(r))
+
+def firstmatch(args, x):
     for (pattern, semantics) in args:
-        result = match(pattern, semantics)
-        if result is not None:
-            return result
-    
-    return cachedordefault(f,x,(None, x))
+        (p,r) = pattern(x)
+        if p is not None:
+            return (semantics(p), r)
+    return (None, x)
+
+def rules(f, x, args):
+    parser = current()
+    if parser is None:
+        return toplevel(f, x)
+    if parser.body is not f:
+        # Called directly, e.g. as a bare alternative, rather than through
+        # applyrule; memoize it like any other application
+        return applyrule(f, x)
+    parser.body = None
+    return firstmatch(args, x)
 
 def expand(f,x):
     return lambda args : rules(f,x,args)
 
+class Rule(object):
+    # A rule whose alternatives are built once, on first use, instead of on
+    # every application as with expand(). The decorated function takes no
+    # arguments and returns the (pattern, semantics) alternatives:
+    #
+    #   @rule
+    #   def Number():
+    #       return ((concat(Number, Digit), lambda t : t[0] * 10 + t[1]),
+    #               (Digit,                 identity))
+    #
+    # Building them lazily lets rules refer to rules defined further down.
+
+    def __init__(self, define):
+        self.define = define
+        self.alternatives = None
+        self.__name__ = define.__name__
+
+    def compile(self):
+        if self.alternatives is None:
+            self.alternatives = tuple(self.define())
+        return self.alternatives
+
+    def __call__(self, x):
+        parser = current()
+        if parser is None:
+            return toplevel(self, x)
+        if parser.body is not self:
+            return applyrule(self, x)
+        parser.body = None
+        return firstmatch(self.alternatives or self.compile(), x)
+
+    def __repr__(self):
+        return '<rule %s>' % self.__name__
+
+def rule(define):
+    return Rule(define)
+
 def identity(x):
-    return x
\ No newline at end of file
+    return x
+
+class ParseError(ValueError):
+
+    def __init__(self, position, results=()):
+        ValueError.__init__(self, 'no parse at position %d' % position)
+        self.position = position
+        # Items close() parsed before the failure
+        self.results = list(results)
+
+class Buffer(object):
+    # The part of a stream an IncrementalParser still needs, indexed by
+    # position in the whole stream so that Streams and memo entries stay
+    # valid as input is added at the end and dropped from the front
+
+    def __init__(self):
+        self.data = ''
+        self.start = 0
+
+    def append(self, data):
+        self.data += data
+
+    def drop(self, pos):
+        self.data = self.data[pos - self.start:]
+        self.start = pos
+
+    def __len__(self):
+        return self.start + len(self.data)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start = self.start if i.start is None else i.start
+            stop = len(self) if i.stop is None else i.stop
+            return self.data[start - self.start:stop - self.start:i.step]
+        if i < self.start:
+            raise IndexError('position %d was dropped' % i)
+        return self.data[i - self.start]
+
+    def __repr__(self):
+        return 'Buffer(%r, %d)' % (self.data, self.start)
+
+class IncrementalParser(object):
+    # Parses a stream of top-level items, e.g. one expression per line, as
+    # the input arrives:
+    #
+    #   stream = IncrementalParser(Term, skip=' \n')
+    #   for chunk in chunks:
+    #       for value in stream.feed(chunk):
+    #           ...
+    #   for value in stream.close():
+    #       ...
+    #
+    # An item is final once its parse never read past the input fed so far;
+    # until then it is retried as more arrives. A retry reuses every memo
+    # entry that did not read past the old end, and a left recursion grows
+    # on from its last result that did not. The rest is redone, so a retry
+    # waits for at least as many new characters as it has entries to redo:
+    # an item that keeps running into the end of the input, e.g. S on
+    # '()()()...' with nothing in between, is then retried less and less
+    # often and the total work stays linear. Characters in skip are dropped
+    # between items. Input and memo entries behind the last final item are
+    # dropped, so memory follows the longest item, not the whole stream.
+    # Stack depth follows the item too (see Parser), so a stream of short
+    # items never needs a raised recursion limit.
+    #
+    # When an item does not parse, feed() still returns the items before it
+    # and the ParseError comes from the next feed() or close(); close()
+    # attaches the items it parsed first to the error as its results.
+
+    def __init__(self, rule, skip=''):
+        self.rule = rule
+        self.skip = skip
+        self.buffer = Buffer()
+        # Stream position of the next item
+        self.pos = 0
+        self.closed = False
+        self.error = None
+        self.parser = Parser()
+        self.parser.track()
+        # Input length at the last attempt, and memo entries the next one
+        # has to redo
+        self.end = 0
+        self.owed = 0
+
+    @property
+    def offset(self):
+        # Characters dropped from the front of the stream so far
+        return self.buffer.start
+
+    def feed(self, data):
+        if self.closed:
+            raise ValueError('feed() after close()')
+        if self.error is not None:
+            raise self.error
+        self.buffer.append(data)
+        if len(self.buffer) - self.end < self.owed:
+            return []
+        return self.results()
+
+    def close(self):
+        self.closed = True
+        if self.error is not None:
+            raise self.error
+        results = self.results()
+        if self.error is not None:
+            raise ParseError(self.error.position, results)
+        return results
+
+    def results(self):
+        (parser, buffer) = (self.parser, self.buffer)
+        # Without new input the entries that read past the end saw it end
+        # where it really does
+        if len(buffer) > self.end:
+            self.owed = parser.invalidate(self.end)
+            self.end = len(buffer)
+        results = []
+        try:
+            while True:
+                while self.pos < len(buffer) and buffer[self.pos] in self.skip:
+                    self.pos += 1
+                if self.pos == len(buffer):
+                    return results
+                parser.reach = 0
+                (p, r) = parser.apply(self.rule, Stream(buffer, self.pos))
+                if not self.closed and parser.reach > len(buffer):
+                    return results
+                if p is None or r.pos == self.pos:
+                    self.error = ParseError(self.pos)
+                    return results
+                results.append(p)
+                self.pos = r.pos
+        finally:
+            buffer.drop(self.pos)
+            parser.forget(self.pos)
@@ -1,17 +1,22 @@
 import os
 import random
-from sqlalchemy import and_, func
+from sqlalchemy import and_
 from flask_apispec import MethodResource, doc, marshal_with, use_kwargs as use_kwargs_doc
 from flask_restful import abort
 from flask_bcrypt import generate_password_hash
 from webargs import fields, validate
 from webargs.flaskparser import use_kwargs
+from marshmallow import missing
 from database import (Algorithm, Cube, Currency, Exchange,
-                      User, UserApiKey, UserNotification)
+                      User, UserApiKey, UserNotification, db_session)
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from .tools.account import delete_user, reset_user
+from .tools.cache import invalidate_api_key, invalidate_user, reference_cache, user_cache
 from .tools.cube import (get_balance_data, asset_allocations_from_balances_all)
-from schemas import (AlgorithmSchema, ExchangeSchema, UserSchema)
+from schemas import (AlgorithmSchema, ExchangeSchema,
+                     UserApiKeySchema, UserNotificationSchema, UserSchema,
+                     UserSlimSchema, dump)
+from serializers import cube_serializer
 
 
 _cryptobal_url = os.getenv('CRYPTOBAL_URL')
@@ -43,7 +48,7 @@ class AccountBalances(MethodResource):
                             user_id=user.id
                             ).filter(and_(
                             Cube.closed_at == None,
-                            func.length(Cube.balances) > 0,
+                            Cube.balances.any(),
                             )).all()
             if cubes:
                 balances, total = get_balance_data(user, cubes)
@@ -119,6 +124,7 @@ class ApiKey(MethodResource):
             secret=secret_hash
             )
         api_key.save_to_db()
+        invalidate_user(user.id, 'api_keys')
         return {'key': key, 'secret': secret}
 
     post_args = {
@@ -137,18 +143,23 @@ class ApiKey(MethodResource):
                 user_id=user.id,
                 key=key
             ).delete()
+            # Committed before the caches are cleared, so a request in
+            # between cannot cache the key again
+            db_session.commit()
+            invalidate_user(user.id, 'api_keys')
+            invalidate_api_key(key)
             return {'message': 'API key deleted'}
         except:
             message = 'A problem was encountered while trying to delete your API key.'
             abort(400, message=message)
 
 
-@marshal_with(AlgorithmSchema(many=True))
+@marshal_with(AlgorithmSchema(many=True), apply=False)
 class AvailableAlgorithms(MethodResource):
     @doc(tags=['Account'], description='Returns available algorithms (also available in User object, may remove this route)')
     @jwt_required
     def get(self):
-        return Algorithm.query.filter_by(active=True).all()
+        return available_algorithms()
 
 
 @marshal_with(ExchangeSchema(many=True))
@@ -322,10 +333,14 @@ class SaveUserSetting(MethodResource):
                 user.save_to_db()
             elif name in ["delete_notification"]:
                 UserNotification.query.filter_by(id=name).delete()
+                db_session.commit()
+                invalidate_user(user.id, 'notifications')
             elif name in ["reset_user"]:
                 reset_user(user.id)
+                invalidate_user(user.id)
             elif name in ["delete"]:
                 delete_user(user.id)
+                invalidate_user(user.id)
                 return {'message': "user deleted, route to landing page"}
             return {'message': 'Setting successfully saved'}
         except Exception as e:
@@ -333,12 +348,59 @@ class SaveUserSetting(MethodResource):
             abort(400, message=message)
 
 
-@marshal_with(UserSchema())
-@doc(tags=['Account'], description='User object')
+def available_algorithms():
+    return reference_cache.get_or_set('available_algorithms', lambda: dump(
+        AlgorithmSchema(many=True), Algorithm.query.filter_by(active=True).all()))
+
+
+def available_exchanges():
+    return reference_cache.get_or_set('available_exchanges', lambda: dump(
+        ExchangeSchema(many=True), Exchange.query.filter_by(active=True).all()))
+
+
+# Expandable user sub-documents. Global lists come from the reference cache,
+# the rest are cached per user and invalidated by the routes that change them.
+user_documents = {
+    'api_keys': lambda user: user_cache.get_or_set(
+        (user.id, 'api_keys'),
+        lambda: dump(UserApiKeySchema(many=True), user.api_keys.all())),
+    'available_algorithms': lambda user: available_algorithms(),
+    'available_exchanges': lambda user: available_exchanges(),
+    'notifications': lambda user: user_cache.get_or_set(
+        (user.id, 'notifications'),
+        lambda: dump(UserNotificationSchema(many=True), user.notifications.all())),
+    'open_cubes': lambda user: user_cache.get_or_set(
+        (user.id, 'open_cubes'),
+        lambda: cube_serializer.dump_many(user.open_cubes)),
+}
+
+
+@marshal_with(UserSchema(), apply=False)
+@doc(tags=['Account'], description='User object. Pass "expand" as a comma separated list of \
+    ("api_keys", "available_algorithms", "available_exchanges", "notifications", "open_cubes") \
+    to include only those sub-documents; an empty "expand" returns the slim user object \
+    and omitting it returns every sub-document.')
 class UserResource(MethodResource):
+    get_args = {
+        'expand': fields.Str(required=False, description='Sub-documents to include'),
+    }
     @jwt_required
-    def get(self):
+    @use_kwargs(get_args, locations=('query',))
+    @use_kwargs_doc(get_args, locations=('query',))
+    def get(self, expand=missing):
+        if expand is missing:
+            expand = list(user_documents)
+        else:
+            expand = [name.strip() for name in expand.split(',') if name.strip()]
+            unknown = set(expand) - set(user_documents)
+            if unknown:
+                abort(422, message='Unknown expand: {}'.format(', '.join(sorted(unknown))))
+
         email = get_jwt_identity()
-        return User.query.filter_by(email=email).first()
+        user = User.query.filter_by(email=email).first()
+        data = dump(UserSlimSchema(), user)
+        for name in expand:
+            data[name] = user_documents[name](user)
+        return data
 
 
@@ -1,6 +1,9 @@
+import hashlib
+import hmac
 import os
+from collections import namedtuple
 import pandas as pd
-from sqlalchemy import and_, func
+from sqlalchemy import and_
 from flask_apispec import MethodResource, doc, marshal_with, use_kwargs as use_kwargs_doc
 from flask_restful import abort
 from flask import Response, jsonify
@@ -8,8 +11,9 @@ from webargs import fields, validate
 from webargs.flaskparser import use_kwargs
 from flask_bcrypt import check_password_hash
 from schemas import AssetSchema, CubeLimitedSchema
-from database import (AssetAllocation, Cube, Currency,
+from database import (AssetAllocation, Cube, Currency, CustomPortfolio,
                       db_session,  User, UserApiKey)
+from .tools.cache import api_key_cache
 from .tools.cube import get_balance_data, asset_allocations_from_balances
 
 
@@ -22,6 +26,44 @@ auth_args = {
     'secret': fields.Str(required=True, description='API secret'),
 }
 
+ApiCredentials = namedtuple('ApiCredentials', ['user_id', 'role'])
+
+# Cache keys hold a digest of the secret rather than the secret itself.
+# The cache is per process, so a per process key will do.
+_digest_key = os.urandom(32)
+
+
+def credentials_digest(key, secret):
+    return hmac.new(_digest_key, '{}:{}'.format(key, secret).encode('utf-8'),
+                    hashlib.sha256).digest()
+
+
+def verify_credentials(key, secret):
+    # Successful checks are cached for a minute, so clients polling the API
+    # skip the key lookup and the bcrypt check. Deleting a key drops its
+    # entries in this worker; the ttl bounds the others.
+    cache_key = (key, credentials_digest(key, secret))
+    credentials = api_key_cache.get(cache_key)
+    if credentials is None:
+        api_key = db_session.query(UserApiKey.user_id, UserApiKey.secret).filter_by(key=key).first()
+        if api_key is None or not check_password_hash(api_key.secret, secret):
+            abort(401, message='Wrong credentials.')
+        user = User.query.get(api_key.user_id)
+        if user is None:
+            # Key left over from a deleted account
+            abort(401, message='Wrong credentials.')
+        credentials = ApiCredentials(user.id, user.role)
+        api_key_cache.set(cache_key, credentials)
+    return credentials
+
+
+def verify_credentials_developer(key, secret):
+    credentials = verify_credentials(key, secret)
+    if credentials.role != 'Developer':
+        abort(403, message='This endpoint requires a developer account.')
+    return credentials
+
+
 def data_frame(query, columns):
     # Takes a sqlalchemy query and a list of columns, returns a dataframe.
     def make_row(x):
@@ -34,17 +76,18 @@ class ApiSummary(MethodResource):
     @use_kwargs_doc(auth_args, locations=('json', 'form'))
     @doc(tags=['API'], description='Retrieves account summary info.')
     def post(self, key, secret):
-        user = verify_credentials(key, secret)
+        credentials = verify_credentials(key, secret)
         try:
             cubes = Cube.query.filter_by(
-                            user_id=user.id
+                            user_id=credentials.user_id
                             ).filter(and_(
                             Cube.closed_at == None,
-                            func.length(Cube.balances) > 0,
+                            Cube.balances.any(),
                             )).all()
             if cubes:
                 cube_ids = [cube.id for cube in cubes]
-                balances, total, performance_fiat = get_balance_data(cubes, user)
+                user = User.query.get(credentials.user_id)
+                balances, total = get_balance_data(user, cubes)
                 allocations = asset_allocations_from_balances(balances)
                 return {
                     'balances': balances, 
@@ -65,14 +108,15 @@ class ApiCubeSummary(MethodResource):
     @use_kwargs_doc(post_args, locations=('json', 'form'))
     @doc(tags=['API'], description='Retrieves cube summary info.')
     def post(self, key, secret, cube_id):
-        user = verify_credentials(key, secret)
+        credentials = verify_credentials(key, secret)
         try:
             cube = Cube.query.filter_by(
-                            user_id=user.id,
+                            user_id=credentials.user_id,
                             id=cube_id,
                             ).first()
             if cube:
-                balances, total, performance_fiat = get_balance_data([cube], user)
+                user = User.query.get(credentials.user_id)
+                balances, total = get_balance_data(user, [cube])
                 allocations = asset_allocations_from_balances(balances)
                 return {
                     'balances': balances, 
@@ -94,9 +138,9 @@ class ApiCubeDetails(MethodResource):
     @use_kwargs_doc(post_args, locations=('json', 'form'))
     @doc(tags=['API'], description='Retrieves cube open orders')
     def post(self, key, secret, cube_id):
-        verify_credentials(key, secret)
+        credentials = verify_credentials(key, secret)
         cube = Cube.query.get(cube_id)
-        if cube:
+        if cube and cube.user_id == credentials.user_id:
             return cube
         else:
             message = 'No cube associated with ID {}'.format(cube_id)
@@ -111,7 +155,7 @@ class ApiPortfolios(MethodResource):
     @use_kwargs_doc(post_args, locations=('json', 'form'))
     @doc(tags=['API'], description='Retrieves cube portfolio')
     def post(self, key, secret, algorithm_id):
-        user = verify_credentials_developer(key, secret)
+        verify_credentials_developer(key, secret)
 
         cubes = Cube.query.filter_by(algorithm_id=algorithm_id).all()
         if not cubes:
@@ -143,7 +187,7 @@ class ApiPostAllocations(MethodResource):
     @use_kwargs_doc(post_args, locations=('json', 'form'))
     @doc(tags=['API'], description='Post allocations for Optimized Index')
     def post(self, key, secret, algorithm_id, allocations, index='top_ten'):
-        user = verify_credentials_developer(key, secret)
+        verify_credentials_developer(key, secret)
 
         if algorithm_id != 6:
             message = 'Currently only allowing allocation adjustments for Risk Optimized Cubes.'
@@ -1,6 +1,6 @@
 import os
+import hmac
 from time import time
-from datetime import datetime
 from hashlib import md5
 import requests as rq
 from flask import request, make_response
@@ -14,6 +14,7 @@ from flask_jwt_extended import (create_access_token, create_refresh_token,
                                 get_jwt_identity, get_raw_jwt)
 from database import Currency, User, RevokedToken, app
 from .tools import security
+from .tools.auth import check_password, last_logins, throttle_login, timed_login
 
 api = Api(app)
 
@@ -25,13 +26,27 @@ SECRET = '124fi21r9'
 TFA_GRACE = 120
 
 
+def second_factor_token(user_id, timestamp):
+    return md5(('{}.{}.{}'.format(user_id, timestamp, SECRET)).encode()).hexdigest()
+
+
+def second_factor(user):
+    # Sent instead of tokens when the account has 2FA; SecondFactor checks
+    # it comes back within TFA_GRACE seconds
+    timestamp = int(time())
+    return {'second_factor': {
+        'user_id': user.id,
+        'timestamp': timestamp,
+        'token': second_factor_token(user.id, timestamp),
+        'role': user.role,
+    }}
+
+
 def login_user(user):
-    user.last_login = datetime.utcnow()
-    user.save_to_db()
+    # last_login is written in the background; the response does not wait
+    last_logins.touch(user.id)
     access_token = create_access_token(identity = user.email)
     refresh_token = create_refresh_token(identity = user.email)
-    print(access_token)
-    print(refresh_token)
     resp = make_response(user.role, 200)
     resp.headers.extend({'authorization': {
         'access_token': access_token,
@@ -135,28 +150,19 @@ class Login(MethodResource):
     @use_kwargs(post_args, locations=('json', 'form'))
     @use_kwargs_doc(post_args, locations=('json', 'form'))
     @doc(tags=['Authentication'], description='Login to account. Must post credentials in body.')
+    @timed_login
     def post(self, email, password):
+        throttle_login(email)
         user = User.query.filter_by(email=email).first()
-        print(user)
         if user is None:
             message = 'There is no account associated with this email address.'
             abort(401, message=message)
         elif not user.email_confirmed:
             abort(403, message=user.first_name)
         else:
-            if user.verify_password(password):
+            if check_password(user, password):
                 if user.otp_complete:
-                    user_id = user.id
-                    timestamp = int(time())
-                    token = md5(('{}.{}.{}'.format(user_id, timestamp, SECRET)).encode()).hexdigest()
-                    print(token)
-                    second_factor = {
-                        'user_id': user_id,
-                        'timestamp': timestamp,
-                        'token': token,
-                        'role': user.role,
-                    }
-                    return {'second_factor': second_factor}
+                    return second_factor(user)
                 else:
                     ### Add back User 'roles' to differentiate access?
                     return login_user(user)
@@ -175,13 +181,12 @@ class SecondFactor(MethodResource):
     @use_kwargs_doc(post_args, locations=('json', 'form'))
     @doc(tags=['Authentication'], description='Second factor authentication')
     def post(self, user_id, timestamp, token, otp_code):
-        new_token = md5(('{}.{}.{}'.format(user_id, timestamp, SECRET)).encode()).hexdigest()
-        if token != new_token:
+        if not hmac.compare_digest(token.encode(), second_factor_token(user_id, timestamp).encode()):
             abort(403, message='Token does not match')
         if (float(timestamp) < time() - TFA_GRACE) or (float(timestamp) > time() + TFA_GRACE):
             abort(403, message='Past grace time for token')
 
-        user = User.query.filter_by(id=user_id).first()
+        user = User.query.get(user_id)
         if user == None:
             abort(403, message='No user.')
         if user.verify_totp(otp_code):
@@ -252,16 +257,7 @@ class OauthValidate(MethodResource):
                     )
                 user.save_to_db()
             elif user.otp_complete:
-                user_id = user.id
-                timestamp = int(time())
-                token = md5(('{}.{}.{}'.format(user_id, timestamp, SECRET)).encode()).hexdigest()
-                second_factor = {
-                    'user_id': user_id,
-                    'timestamp': timestamp,
-                    'token': token,
-                    'role': user.role,
-                }
-                return {'second_factor': second_factor}
+                return second_factor(user)
             return login_user(user)
         else:
             abort(401)
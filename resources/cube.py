@@ -5,10 +5,13 @@ from webargs.flaskparser import use_kwargs
 from marshmallow import missing
 from sqlalchemy import or_
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from database import (Algorithm, Cube, Indices, Transaction, User)
+from database import (Algorithm, Cube, Indices, Transaction, User, column_query)
 from schemas import (CubeSchema, ExPairSchema, TransactionSchema)
+from serializers import (cube_serializer, ex_pair_serializer,
+                         transaction_serializer, json_response)
 from .tools.cube import *
 from .tools.account import reset_cube, delete_cube
+from .tools.cache import invalidate_user
 
 
 # ----------------------------------------------- Cube Resources
@@ -149,6 +152,7 @@ class ConnectionResource(MethodResource):
             if not delete_cube(existing_cube.id):
                 message = 'Problem creating cube'
                 abort(404, message=message)
+            invalidate_user(user.id, 'open_cubes')
         # Get fiat id
         fiat_pair = ExPair.query.filter_by(
             exchange_id=ex_id,
@@ -180,10 +184,12 @@ class ConnectionResource(MethodResource):
             test, message = test_key(cube, ex_id, key, secret, passphrase)
             if test:
                 message = add_key(cube, ex_id, key, secret, passphrase)
+                invalidate_user(user.id, 'open_cubes')
                 return {'message': message, 'cube_id': cube.id}
             else:
                 db_session.delete(cube)
                 db_session.commit()
+                invalidate_user(user.id, 'open_cubes')
                 abort(400, message=message)
         else:
             message = 'Problem creating cube'
@@ -213,6 +219,7 @@ class ConnectionResource(MethodResource):
                 cube.connections[exchange_name].failed_at = None
                 db_session.add(cube)
                 db_session.commit()
+                invalidate_user(cube.user_id, 'open_cubes')
                 return {'message': message}
             else:
                 abort(400, message=message)
@@ -234,13 +241,14 @@ class ConnectionResource(MethodResource):
         if cube:
             ex_id = Exchange.query.filter_by(name=exchange_name).one().id
             message = remove_key(cube, ex_id)
+            invalidate_user(cube.user_id, 'open_cubes')
             return {'message': message}
         else:
             message = 'No cube associated with ID {}'.format(cube_id)
             abort(404, message=message)
 
 
-@marshal_with(CubeSchema())
+@marshal_with(CubeSchema(), apply=False)
 class CubeResource(MethodResource):
     @jwt_required
     @use_kwargs(post_args, locations=('json', 'form'))
@@ -251,13 +259,13 @@ class CubeResource(MethodResource):
         cube = Cube.query.get(cube_id)
         # is_owner(cube, email)
         if cube:
-            return cube
+            return json_response(cube_serializer.dump(cube))
         else:
             message = 'No cube associated with ID {}'.format(cube_id)
             abort(404, message=message)
 
 
-@marshal_with(ExPairSchema(many=True))
+@marshal_with(ExPairSchema(many=True), apply=False)
 class ExPairResource(MethodResource):
     @jwt_required
     @use_kwargs(post_args, locations=('json', 'form'))
@@ -265,14 +273,14 @@ class ExPairResource(MethodResource):
     @doc(tags=['Cube'], description='Cube object')
     def post(self, cube_id):
         # email = get_jwt_identity()
-        cube = Cube.query.get(cube_id)
+        exchange_id = db_session.query(Cube.exchange_id).filter_by(id=cube_id).scalar()
         # is_owner(cube, email)
-        if cube:
-            ex_pairs = ExPair.query.filter_by(
-                                exchange_id=cube.exchange.id,
-                                active=True
+        if exchange_id:
+            ex_pairs = column_query(ExPair, ex_pair_serializer.field_names).filter(
+                                ExPair.exchange_id == exchange_id,
+                                ExPair.active == True
                                 ).all()
-            return ex_pairs
+            return json_response(ex_pair_serializer.dump_rows(ex_pairs))
         else:
             message = 'No cube associated with ID {}'.format(cube_id)
             return message
@@ -297,6 +305,9 @@ class SaveCubeSetting(MethodResource):
         cube = Cube.query.get(cube_id)
         # is_owner(cube, email)
         if cube:
+            # Invalidated only once the change is committed, so a request
+            # in between cannot cache the old state again
+            user_id = cube.user_id
             bool_value = 1 if value == "true" else 0
             if name in ["auto_rebalance", "unrecognized_activity"]:
                 setattr(cube, name, bool_value)
@@ -328,17 +339,19 @@ class SaveCubeSetting(MethodResource):
                     abort(500)
             elif name in ["delete"]:
                 if delete_cube(cube.id):
+                    invalidate_user(user_id, 'open_cubes')
                     return {'message': f'Cube {cube_id} deleted'}
                 else:
                     abort(500)
             cube.save_to_db()
+            invalidate_user(user_id, 'open_cubes')
             return {'message': 'Setting successfully saved'}
         else:
             message = 'No cube associated with ID {}'.format(cube_id)
             abort(404, message=message)
 
 
-@marshal_with(TransactionSchema(many=True))
+@marshal_with(TransactionSchema(many=True), apply=False)
 class Transactions(MethodResource):
     @jwt_required
     @use_kwargs(post_args, locations=('json', 'form'))
@@ -346,9 +359,8 @@ class Transactions(MethodResource):
     @doc(tags=['Cube'], description='Retrieves transactions for Cube.')
     def post(self, cube_id):
         # email = get_jwt_identity()
-        cube = Cube.query.get(cube_id)
         # is_owner(cube, email)
-        txs = Transaction.query.filter(
+        txs = column_query(Transaction, transaction_serializer.field_names).filter(
                     Transaction.cube_id == cube_id,
                     or_(
                         Transaction.base_amount != 0,
@@ -357,10 +369,7 @@ class Transactions(MethodResource):
                     ).order_by(
                         Transaction.datetime.desc()
                     ).all()
-        if txs:
-            return txs
-        else:
-            return []
+        return json_response(transaction_serializer.dump_rows(txs))
 
 
 class Valuations(MethodResource):
@@ -4,7 +4,8 @@ from webargs.flaskparser import use_kwargs
 from webargs import fields 
 from flask_apispec import MethodResource, marshal_with, doc, use_kwargs as use_kwargs_doc
 from schemas import ExchangeSchema, ExchangeAssetsSchema, SupportedAssetsSchema, ExPairSchema
-from database import Currency, db_session, ExPair, Exchange, and_
+from database import Currency, column_query, db_session, ExPair, Exchange, and_
+from serializers import ex_pair_serializer, exchange_serializer, json_response
 
 
 post_args = {
@@ -50,13 +51,14 @@ class SupportedAssets(MethodResource):
             abort(500, message='Something went wrong')
 
 
-@marshal_with(ExchangeSchema(many=True))
+@marshal_with(ExchangeSchema(many=True), apply=False)
 @doc(tags=['Content'], description='Supported exchanges')
 class SupportedExchanges(MethodResource):
     def get(self):
-        exchanges = Exchange.query.filter_by(active=True).all()
+        exchanges = column_query(Exchange, exchange_serializer.field_names).filter(
+            Exchange.active == True).all()
         if exchanges:
-            return exchanges
+            return json_response(exchange_serializer.dump_rows(exchanges))
         else:
             message = 'No exchanges'
             abort(404, message=message)
@@ -74,13 +76,14 @@ class SupportedExchangeAssets(MethodResource):
             abort(404, message=message)
 
 
-@marshal_with(ExPairSchema(many=True))
+@marshal_with(ExPairSchema(many=True), apply=False)
 @doc(tags=['Content'], description='Supported exchange pairs')
 class SupportedExchangePairs(MethodResource):
     def get(self):
-        ex_pairs = ExPair.query.filter_by(active=True).all()
+        ex_pairs = column_query(ExPair, ex_pair_serializer.field_names).filter(
+            ExPair.active == True).all()
         if ex_pairs:
-            return ex_pairs
+            return json_response(ex_pair_serializer.dump_rows(ex_pairs))
         else:
             message = 'No exchange pairs matching the name'
             abort(404, message=message)
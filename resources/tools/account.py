@@ -1,4 +1,5 @@
 from database import *
+from .cache import invalidate_api_key
 
 
 BASE_RATE = 1
@@ -44,6 +45,8 @@ def reset_cube(cube_id):
     try:
         AssetAllocation.query.filter_by(cube_id=cube_id).delete()
         Balance.query.filter_by(cube_id=cube_id).delete()
+        for conn in Connection.query.filter_by(cube_id=cube_id):
+            conn.forget_decrypted()
         Connection.query.filter_by(cube_id=cube_id).delete()
         ConnectionError.query.filter_by(cube_id=cube_id).delete()
         CubeUserAction.query.filter_by(cube_id=cube_id).delete()
@@ -88,10 +91,13 @@ def delete_user(user_id):
     try:
         if reset_user(user_id):
             ConnectionError.query.filter_by(user_id=user_id).delete()
+            keys = [key for (key,) in db_session.query(UserApiKey.key).filter_by(user_id=user_id)]
             UserApiKey.query.filter_by(user_id=user_id).delete()
             UserNotification.query.filter_by(user_id=user_id).delete()
             User.query.filter_by(id=user_id).delete()
             db_session.commit()
+            for key in keys:
+                invalidate_api_key(key)
             return True
     except:
         return False
\ No newline at end of file
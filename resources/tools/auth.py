@@ -0,0 +1,211 @@
+import atexit
+import logging
+import os
+import threading
+from collections import defaultdict, deque
+from datetime import datetime
+from functools import wraps
+from time import monotonic, sleep
+from flask import request
+from flask_restful import abort
+from sqlalchemy import bindparam
+from werkzeug.exceptions import HTTPException, ServiceUnavailable
+from database import bcrypt, engine, User
+
+
+log = logging.getLogger(__name__)
+
+
+# Password checks a worker process runs at once. bcrypt releases the GIL,
+# but it holds the request thread for its whole run, so this stays below
+# uwsgi's 2 threads per process to leave one for other requests. A login
+# waits up to HASH_WAIT seconds for a slot, about two checks at the
+# default cost, then gets a 503 asking it to retry after HASH_RETRY_AFTER.
+HASH_SLOTS = int(os.getenv('LOGIN_HASH_SLOTS', 1))
+HASH_WAIT = float(os.getenv('LOGIN_HASH_WAIT', 0.5))
+HASH_RETRY_AFTER = 1
+
+# Login attempts allowed per client address and per email address within
+# ATTEMPT_WINDOW seconds. A successful login clears the email's count.
+IP_ATTEMPTS = int(os.getenv('LOGIN_IP_ATTEMPTS', 30))
+EMAIL_ATTEMPTS = int(os.getenv('LOGIN_EMAIL_ATTEMPTS', 10))
+ATTEMPT_WINDOW = int(os.getenv('LOGIN_ATTEMPT_WINDOW', 300))
+
+# Seconds between writes of batched last_login times
+LAST_LOGIN_INTERVAL = int(os.getenv('LAST_LOGIN_INTERVAL', 5))
+
+
+class ServerBusy(ServiceUnavailable):
+
+    def get_headers(self, *args, **kwargs):
+        headers = super(ServerBusy, self).get_headers(*args, **kwargs)
+        headers.append(('Retry-After', str(HASH_RETRY_AFTER)))
+        return headers
+
+
+class Throttle(object):
+    # Sliding window of attempts per key. Like the caches in cache.py it is
+    # per worker process, so the effective limit is per worker.
+
+    def __init__(self, limit, window, maxsize=10000):
+        self.limit = limit
+        self.window = window
+        self.maxsize = maxsize
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        # Records an attempt; False if the key is already at its limit
+        now = monotonic()
+        with self._lock:
+            attempts = self._attempts.get(key)
+            if attempts is None:
+                if len(self._attempts) >= self.maxsize:
+                    self._prune(now)
+                attempts = self._attempts[key] = deque()
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            if len(attempts) >= self.limit:
+                return False
+            attempts.append(now)
+            return True
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
+
+    def _prune(self, now):
+        # Drop keys with no attempt left in the window, then the oldest key
+        for key in [k for k, a in self._attempts.items() if not a or a[-1] <= now - self.window]:
+            del self._attempts[key]
+        if len(self._attempts) >= self.maxsize:
+            del self._attempts[next(iter(self._attempts))]
+
+
+class LatencyStats(object):
+    # Recent latencies per outcome, logged every `every` observations
+
+    def __init__(self, name, size=1000, every=100):
+        self.name = name
+        self.every = every
+        self.count = 0
+        self._samples = defaultdict(lambda: deque(maxlen=size))
+        self._lock = threading.Lock()
+
+    def observe(self, outcome, seconds):
+        with self._lock:
+            self._samples[outcome].append(seconds)
+            self.count += 1
+            report = self.count % self.every == 0
+        if report:
+            log.info('%s latency: %s', self.name, self.summary())
+
+    def summary(self):
+        with self._lock:
+            samples = {outcome: sorted(s) for outcome, s in self._samples.items()}
+        return {outcome: {
+            'count': len(s),
+            'p50': round(s[len(s) // 2], 4),
+            'p95': round(s[int(len(s) * 0.95)], 4),
+            'max': round(s[-1], 4),
+        } for outcome, s in samples.items()}
+
+
+class LastLoginBatcher(object):
+    # Collects last_login times in memory, latest per user, and writes them
+    # from a background thread every `interval` seconds in one executemany
+    # UPDATE, so logins do not wait on a commit. The thread is started on
+    # first use rather than at import, since uwsgi forks workers after
+    # loading the app and threads do not survive a fork. A worker that
+    # dies loses at most `interval` seconds of last_login times.
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        users = User.__table__
+        self._update = users.update().where(
+            users.c.id == bindparam('user_id')).values(last_login=bindparam('at'))
+
+    def touch(self, user_id, at=None):
+        with self._lock:
+            self._pending[user_id] = at or datetime.utcnow()
+            if self._pid != os.getpid():
+                self._start()
+
+    def flush(self):
+        with self._lock:
+            (pending, self._pending) = (self._pending, {})
+        if not pending:
+            return
+        try:
+            with engine.begin() as conn:
+                conn.execute(self._update, [
+                    {'user_id': user_id, 'at': at} for (user_id, at) in pending.items()])
+        except Exception:
+            log.exception('Could not write %d last_login times', len(pending))
+            with self._lock:
+                # Keep them for the next flush unless a newer login came in
+                for (user_id, at) in pending.items():
+                    self._pending.setdefault(user_id, at)
+
+    def _start(self):
+        self._pid = os.getpid()
+        thread = threading.Thread(target=self._run, name='last-login', daemon=True)
+        thread.start()
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            self.flush()
+
+
+hash_slots = threading.BoundedSemaphore(HASH_SLOTS)
+ip_throttle = Throttle(IP_ATTEMPTS, ATTEMPT_WINDOW)
+email_throttle = Throttle(EMAIL_ATTEMPTS, ATTEMPT_WINDOW)
+login_stats = LatencyStats('login')
+last_logins = LastLoginBatcher(LAST_LOGIN_INTERVAL)
+atexit.register(last_logins.flush)
+
+
+def timed_login(f):
+    # Records how long the wrapped route took, by response status
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        start = monotonic()
+        outcome = 'error'
+        try:
+            result = f(*args, **kwargs)
+            outcome = 'ok'
+            return result
+        except HTTPException as e:
+            outcome = str(e.code)
+            raise
+        finally:
+            login_stats.observe(outcome, monotonic() - start)
+    return wrapper
+
+
+def throttle_login(email):
+    # Called before anything is hashed
+    if not ip_throttle.allow(request.remote_addr) or not email_throttle.allow(email.lower()):
+        abort(429, message='Too many login attempts. Try again later.')
+
+
+def check_password(user, password):
+    if not hash_slots.acquire(timeout=HASH_WAIT):
+        busy = ServerBusy()
+        busy.data = {'message': 'The server is busy. Try again in a moment.'}
+        raise busy
+    try:
+        if not bcrypt.check_password_hash(user.password_hash, password):
+            return False
+        # Upgrades the hash to the configured cost in the same slot
+        if user.password_needs_rehash:
+            user.password_hash = bcrypt.generate_password_hash(password)
+            user.save_to_db()
+    finally:
+        hash_slots.release()
+    email_throttle.reset(user.email.lower())
+    return True
@@ -0,0 +1,88 @@
+import threading
+from time import monotonic
+
+
+_missing = object()
+
+
+class TTLCache(object):
+    # Small thread-safe in-process cache with per-entry expiry. Every uwsgi
+    # worker holds its own copy, so invalidate() only clears the local worker
+    # and the ttl is what bounds staleness across workers.
+
+    def __init__(self, ttl, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.maxsize:
+                self._evict()
+            self._data[key] = (monotonic() + (ttl or self.ttl), value)
+
+    def get_or_set(self, key, loader, ttl=None):
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _evict(self):
+        # Drop expired entries first, then the oldest insert if still full
+        now = monotonic()
+        for key in [k for k, (exp, _) in self._data.items() if exp < now]:
+            del self._data[key]
+        if len(self._data) >= self.maxsize:
+            del self._data[next(iter(self._data))]
+
+
+# Global lists (active algorithms, exchanges, ...) shared by every user
+reference_cache = TTLCache(ttl=300)
+
+# Serialized per-user sub-documents keyed by (user_id, name)
+user_cache = TTLCache(ttl=30, maxsize=4096)
+
+# Verified API credentials keyed by (key, digest of key and secret)
+api_key_cache = TTLCache(ttl=60, maxsize=4096)
+
+
+def invalidate_user(user_id, *names):
+    # Drop cached sub-documents for a user; all of them if no names given
+    if names:
+        for name in names:
+            user_cache.delete((user_id, name))
+    else:
+        user_cache.delete_where(lambda key: key[0] == user_id)
+
+
+def invalidate_api_key(key):
+    api_key_cache.delete_where(lambda cache_key: cache_key[0] == key)
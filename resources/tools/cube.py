@@ -2,13 +2,14 @@ import os
 import math
 from time import sleep
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 import requests as rq
 from flask_restful import abort
 from database import (and_, app, AssetAllocation, Balance, Connection, 
-                      Currency, db_session, e,
-                      Exchange, ExPair,
-                      func, IndexPair, or_, Transaction)
+                      Cube, Currency, db_session, DUST_AMT, e,
+                      Exchange, ExPair, ExPairClose,
+                      func, IndexPair, IndexPairClose, or_, Transaction)
 
 
 API_RETRIES = 3
@@ -17,6 +18,16 @@ GRACE_TIME = 5
 _cryptobal_url = os.getenv('CRYPTOBAL_URL')
 _exapi_url = os.getenv('EXAPI_URL')
 
+# Column name and dtype of the per-asset balance frame
+BALANCE_FRAME = (
+    ('Asset', object),
+    ('Balance', 'float64'),
+    ('BTC_Rate', 'float64'),
+    ('1h_BTC_Change', 'float64'),
+    ('1d_BTC_Change', 'float64'),
+    ('1w_BTC_Change', 'float64'),
+)
+
 
 def asset_allocations(cube):
 
@@ -126,78 +137,149 @@ def asset_allocations_from_balances_all(balances, cube=None):
     return assets
 
 
+def typed_frame(rows, schema):
+    # Builds a frame one column at a time from query rows, casting each
+    # column once (Decimal -> float64, None -> NaN) instead of per value.
+    names = [name for name, dtype in schema]
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    return pd.DataFrame({name: np.array(column, dtype=dtype)
+                         for (name, dtype), column in zip(schema, columns)},
+                        columns=names)
+
+
+def render_frame(frame, index=False, na_value=0):
+    # Presentation step: NaN only becomes a placeholder here
+    header = frame.columns.tolist()
+    if index:
+        frame = frame.reset_index()
+    values = frame.fillna(na_value).values.tolist()
+    return {'header': header or [], 'values': values or []}
+
+
+def btc_rates(balance_keys):
+    # BTC rate per (exchange_id, currency_id) with the same pair and close
+    # choice as Balance.btc_rate, fetched in one query. Missing pairs are
+    # left out so callers see NaN.
+    balance_keys = set(balance_keys)
+    if not balance_keys:
+        return {}
+    btc_id = db_session.query(Currency.id).filter_by(symbol='BTC').scalar()
+    exchange_ids = {ex_id for ex_id, cur_id in balance_keys}
+    currency_ids = {cur_id for ex_id, cur_id in balance_keys}
+    pairs = db_session.query(
+                ExPair.exchange_id, ExPair.base_currency_id, ExPair.quote_currency_id,
+                ExPair.base_symbol, ExPairClose.close
+            ).outerjoin(
+                ExPairClose, ExPairClose.ex_pair_id == ExPair.id
+            ).filter(
+                ExPair.exchange_id.in_(exchange_ids),
+                or_(and_(ExPair.quote_currency_id == btc_id,
+                         ExPair.base_currency_id.in_(currency_ids)),
+                    and_(ExPair.base_currency_id == btc_id,
+                         ExPair.quote_currency_id.in_(currency_ids)))
+            ).order_by(ExPair.id, ExPairClose.id).all()
+
+    quoted, inverse = {}, {}
+    for p in pairs:
+        if p.quote_currency_id == btc_id:
+            quoted.setdefault((p.exchange_id, p.base_currency_id), p)
+        else:
+            inverse.setdefault((p.exchange_id, p.quote_currency_id), p)
+
+    rates = {}
+    for key in balance_keys:
+        pair = quoted.get(key) or inverse.get(key)
+        if pair is None:
+            continue
+        try:
+            close = float(pair.close)
+            rates[key] = 1 / close if pair.base_symbol == 'BTC' else close
+        except (TypeError, ZeroDivisionError):
+            rates[key] = 0
+    return rates
+
+
 def create_series_chart(df):
     df.index = (df.index.values.astype(float) / 1000000).astype(float)
     return [list(p) for p in df.iteritems() if not math.isnan(p[1])]
 
 
+def account_balance_matrix(cube_ids):
+    # Asset x exchange matrix of summed balances, grouped in the database
+    rows = db_session.query(
+                Currency.symbol, Cube.name, func.sum(Balance.total)
+            ).join(Balance.currency).join(Balance.cube).filter(
+                Balance.cube_id.in_(cube_ids),
+                or_(Balance.total > DUST_AMT, Currency.symbol == 'BTC')
+            ).group_by(Currency.symbol, Cube.name).all()
+    bals = typed_frame(rows, (('Asset', object), ('Exchange', object),
+                              ('Balance', 'float64')))
+    return bals.pivot(index='Asset', columns='Exchange', values='Balance')
+
+
+def index_btc_rates(symbols):
+    # BTC rate per symbol from index pairs, same pair choice as looking each
+    # symbol up on its own: BTC-quoted pair first, then the inverse BTC pair.
+    symbols = [symbol for symbol in symbols if symbol != 'BTC']
+    rates = {'BTC': 1}
+    if not symbols:
+        return rates
+    currency_ids = {}
+    for symbol, cur_id in db_session.query(Currency.symbol, Currency.id).filter(
+            Currency.symbol.in_(symbols)).order_by(Currency.id):
+        currency_ids.setdefault(symbol, cur_id)
+    pairs = db_session.query(
+                IndexPair.base_currency_id, IndexPair.base_symbol,
+                IndexPair.quote_symbol, IndexPairClose.close
+            ).outerjoin(
+                IndexPairClose, IndexPairClose.ex_pair_id == IndexPair.id
+            ).filter(
+                IndexPair.active == True,
+                or_(and_(IndexPair.quote_symbol == 'BTC',
+                         IndexPair.base_currency_id.in_(currency_ids.values())),
+                    and_(IndexPair.base_symbol == 'BTC',
+                         IndexPair.quote_symbol.in_(symbols)))
+            ).order_by(IndexPair.id, IndexPairClose.id).all()
+    quoted, inverse = {}, {}
+    for p in pairs:
+        if p.quote_symbol == 'BTC':
+            quoted.setdefault(p.base_currency_id, p.close or 0)
+        else:
+            inverse.setdefault(p.quote_symbol, p.close or 0)
+
+    for symbol in symbols:
+        if symbol not in currency_ids:
+            rates[symbol] = 0
+        elif currency_ids[symbol] in quoted:
+            rates[symbol] = quoted[currency_ids[symbol]]
+        elif symbol in inverse:
+            btc_fiat = inverse[symbol]
+            rates[symbol] = round(1 / btc_fiat, 8) if btc_fiat > 0 else 0
+        else:
+            app.logger.debug('No index for %s' % symbol)
+            rates[symbol] = 0
+    return rates
+
+
+def allocation_targets(cube):
+    return pd.Series({symbol: float(a.percent or 0)
+                      for symbol, a in cube.allocations.items()}, dtype='float64')
+
+
 def get_balance_data(user, cubes):
     app.logger.debug("Start get_balance_data()")
     app.logger.debug(datetime.utcnow())
     # Child rows for per exchange balances
-    bals = [(b.currency.symbol, b.cube.name, float(b.total)) for cube in cubes
-            for b in cube.balances if (b.total > 9e-8) or (b.currency.symbol == 'BTC')]
-    bals = pd.DataFrame(bals, columns=['Asset', 'Exchange', 'Balance'])
-    bals = bals.pivot(index='Asset', columns='Exchange', values='Balance')
+    bals = account_balance_matrix([cube.id for cube in cubes])
     # # Multiply the performance by the exchanges to get a weighed performance value
-    bals['Total'] = bals.sum(axis=1)
-    bals = bals.fillna('-')
-    bals = bals.applymap(lambda x: '%.8f' % x if type(x) is float else x)
-
-    total_bals = bals.Total
-    total_bals = total_bals.to_frame()
-
-    btc_rate = []
-    for symbol in total_bals.index:
-        app.logger.debug(symbol)
-        # Get ex_pair
-        if symbol == 'BTC':
-            btc_rate.append(1)
-        else:
-            cur = Currency.query.filter_by(symbol=symbol).first()
-            print(cur)
-            if not cur:
-                btc_rate.append(0)
-                continue
-            index_pair = IndexPair.query.filter_by(quote_symbol='BTC',
-                                                   base_currency_id=cur.id,
-                                                   active=True).first()
-
-            print(index_pair)
-
-            if not index_pair:
-                index_pair = IndexPair.query.filter_by(quote_symbol=symbol,
-                                                       base_symbol='BTC',
-                                                       active=True).first()
-                print(index_pair)
-
-                if not index_pair:
-                    print('No index for', symbol)
-                    btc_rate.append(0)
-                    continue
-
-                try:
-                    btc_fiat = index_pair.index_pair_close[0].close
-                except:
-                    btc_fiat = 0
-
-                if btc_fiat > 0:
-                    rate = round(1 / btc_fiat, 8)
-                else:
-                    rate = 0
-                print(rate)
-                btc_rate.append(rate)
-            else:
-                try:
-                    rate = index_pair.index_pair_close[0].close
-                except:
-                    rate = 0
-                print(rate)
-                btc_rate.append(rate)
-            app.logger.debug(index_pair)
+    bals['Total'] = bals.sum(axis=1).round(8)
+
+    total_bals = bals[['Total']].copy()
+
+    rates = index_btc_rates(total_bals.index)
     app.logger.debug("Retrieved BTC rates")
     app.logger.debug(datetime.utcnow())
-    app.logger.debug(btc_rate)
+    app.logger.debug(rates)
 
     # Find btc_fiat rate if not in bals
     fiat = IndexPair.query.filter_by(
@@ -210,8 +292,8 @@ def get_balance_data(user, cubes):
         selected_btc_fiat = 0
 
 
-    total_bals['BTC_Rate'] = btc_rate
-    total_bals[['Total', 'BTC_Rate']] = total_bals[['Total', 'BTC_Rate']].astype(float)
+    total_bals['BTC_Rate'] = np.array([rates[symbol] for symbol in total_bals.index],
+                                      dtype='float64')
 
     total_bals['BTC_Value'] = total_bals.Total.multiply(total_bals.BTC_Rate)
 
@@ -221,27 +303,11 @@ def get_balance_data(user, cubes):
     total_bals['Percent_of_Portfolio'] = total_bals.BTC_Value.divide(total_btc)
 
 
-    def target_mapper(bal):
-        for cube in cubes:
-            if bal.name in cube.allocations:
-                return float(cube.allocations[bal.name].percent)
-            else:
-                return 0
-
-    total_bals['Target'] = total_bals.apply(target_mapper, axis=1)
-
-
-    def percent_off_mapper(bal):
-        for cube in cubes:
-            if bal.name in cube.allocations:
-                target = float(cube.allocations[bal.name].percent)
-            else:
-                target = 0
-            if target == 0:
-                return 0
-            return (bal.Percent_of_Portfolio - target) / target
-
-    total_bals['Percent_Off_Goal'] = total_bals.apply(percent_off_mapper, axis=1)
+    # Targets come from the first cube's allocations
+    targets = allocation_targets(cubes[0]) if cubes else pd.Series(dtype='float64')
+    total_bals['Target'] = total_bals.index.to_series().map(targets).fillna(0.0)
+    percent_off = (total_bals.Percent_of_Portfolio - total_bals.Target).divide(total_bals.Target)
+    total_bals['Percent_Off_Goal'] = percent_off.where(total_bals.Target != 0, 0.0)
 
 
     total_btc = total_bals.BTC_Value.sum()
@@ -250,15 +316,7 @@ def get_balance_data(user, cubes):
 
     total_bals = total_bals[total_bals.Fiat_Value >= 1].copy()
 
-    header = total_bals.columns.tolist()
-    total_bals = total_bals.reset_index()
-    total_bals = total_bals.fillna(0)
-    values = total_bals.values.tolist()
-
-
-    balances = {}
-    balances['header'] = header or []
-    balances['values'] = values or []
+    balances = render_frame(total_bals, index=True)
 
 
     total = {}
@@ -271,18 +329,21 @@ def get_balance_data(user, cubes):
 
 def get_balance_data_single(cube):
 
-    bals = [(b.currency.symbol,
-             float(b.total),
-             float(b.btc_rate),
-             b.currency.percent_change_1h / 100 if b.currency.percent_change_1h else 0,
-             b.currency.percent_change_24h / 100 if b.currency.percent_change_24h else 0,
-             b.currency.percent_change_7d / 100 if b.currency.percent_change_7d else 0)
-            for b in cube.balances if (b.total > 9e-8) or (b.currency.symbol == 'BTC')]
-
-
-    bals = pd.DataFrame(bals, columns=['Asset', 'Balance', 'BTC_Rate', '1h_BTC_Change', '1d_BTC_Change', '1w_BTC_Change'])
-    bals = bals.fillna('-')
-    print(bals)
+    rows = db_session.query(
+                Currency.symbol, Balance.total, Balance.exchange_id, Balance.currency_id,
+                Currency.percent_change_1h, Currency.percent_change_24h,
+                Currency.percent_change_7d
+            ).join(Balance.currency).filter(
+                Balance.cube_id == cube.id,
+                or_(Balance.total > DUST_AMT, Currency.symbol == 'BTC')
+            ).all()
+    rates = btc_rates([(r.exchange_id, r.currency_id) for r in rows])
+    bals = typed_frame([(r.symbol, r.total,
+                         1 if r.symbol == 'BTC' else rates.get((r.exchange_id, r.currency_id)),
+                         r.percent_change_1h, r.percent_change_24h, r.percent_change_7d)
+                        for r in rows], BALANCE_FRAME)
+    changes = ['1h_BTC_Change', '1d_BTC_Change', '1w_BTC_Change']
+    bals[changes] = bals[changes] / 100
 
 
     bals['BTC_Value'] = bals.Balance.multiply(bals.BTC_Rate)
@@ -292,7 +353,6 @@ def get_balance_data_single(cube):
         base_symbol='BTC'
     ).first()
     print(fiat)
-    print(fiat.ex_pair_close[0].close)
     try:
         selected_btc_fiat = fiat.ex_pair_close[0].close
     except:
@@ -303,25 +363,9 @@ def get_balance_data_single(cube):
     bals['Percent_of_Portfolio'] = bals.BTC_Value.divide(total_btc)
 
 
-    def target_mapper(bal):
-        if bal.Asset in cube.allocations:
-            return float(cube.allocations[bal.Asset].percent)
-        else:
-            return 0
-
-    bals['Target'] = bals.apply(target_mapper, axis=1)
-
-
-    def percent_off_mapper(bal):
-        if bal.Asset in cube.allocations:
-            target = float(cube.allocations[bal.Asset].percent)
-        else:
-            target = 0
-        if target == 0:
-            return 0
-        return (bal.Percent_of_Portfolio - target) / target
-
-    bals['Percent_Off_Goal'] = bals.apply(percent_off_mapper, axis=1)
+    bals['Target'] = bals.Asset.map(allocation_targets(cube)).fillna(0.0)
+    percent_off = (bals.Percent_of_Portfolio - bals.Target).divide(bals.Target)
+    bals['Percent_Off_Goal'] = percent_off.where(bals.Target != 0, 0.0)
 
 
     total_btc = bals.BTC_Value.sum()
@@ -330,14 +374,8 @@ def get_balance_data_single(cube):
 
     bals = bals[bals.Fiat_Value >= 1].copy()
 
-    header = bals.columns.tolist()
-    bals = bals.fillna(0)
-    values = bals.values.tolist()
-
     # Balances
-    balances = {}
-    balances['header'] = header or []
-    balances['values'] = values or []
+    balances = render_frame(bals)
 
     # Totals
     total = {}
@@ -489,8 +527,15 @@ def add_key(cube, ex_id, key, secret, passphrase):
         return message
 
 
+def forget_keys(cube_id, ex_id):
+    # Wipes cached plaintext of the keys about to be replaced or removed
+    for conn in Connection.query.filter_by(cube_id=cube_id, exchange_id=ex_id):
+        conn.forget_decrypted()
+
+
 def update_key(cube, ex_id, key, secret, passphrase):
     remove_balances(ex_id, cube)
+    forget_keys(cube.id, ex_id)
     Connection.query.filter_by(
             cube_id=cube.id,
             exchange_id=ex_id).update({'key': e(key),
@@ -520,6 +565,7 @@ def remove_key(cube, ex_id):
         remove_balances(ex_id, cube)
         Order.query.filter_by(cube_id=cube.id).filter(Order.ex_pair.has(exchange_id=ex_id)).delete(synchronize_session='fetch')
         # Delete Connection
+        forget_keys(cube.id, ex_id)
         Connection.query.filter_by(
                 cube_id=cube.id,
                 exchange_id=ex_id).delete()
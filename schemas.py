@@ -160,10 +160,7 @@ class UserNotificationSchema(Schema):
     message = fields.Str()
 
 
-class UserSchema(Schema):
-    api_keys = fields.List(fields.Nested(UserApiKeySchema))
-    available_algorithms = fields.List(fields.Nested(AlgorithmSchema))
-    available_exchanges = fields.List(fields.Nested(ExchangeSchema))
+class UserSlimSchema(Schema):
     email = fields.Email()
     first_name = fields.Str()
     email_confirmed = fields.Bool()
@@ -175,7 +172,19 @@ class UserSchema(Schema):
     portfolio = fields.Bool()
     fiat = fields.Nested(CurrencySchema)
     fiat_id = fields.Int()
+    role = fields.Str()
+    social_id = fields.Str()
+
+
+class UserSchema(UserSlimSchema):
+    api_keys = fields.List(fields.Nested(UserApiKeySchema))
+    available_algorithms = fields.List(fields.Nested(AlgorithmSchema))
+    available_exchanges = fields.List(fields.Nested(ExchangeSchema))
     notifications = fields.List(fields.Nested(UserNotificationSchema))
     open_cubes = fields.List(fields.Nested(CubeSchema))
-    role = fields.Str()
-    social_id = fields.Str()
\ No newline at end of file
+
+
+def dump(schema, obj):
+    # marshmallow 2 wraps the output in a MarshalResult, 3 returns it directly
+    result = schema.dump(obj)
+    return getattr(result, 'data', result)
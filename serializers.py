@@ -0,0 +1,164 @@
+from datetime import date, datetime
+from decimal import Decimal
+from operator import attrgetter
+import simplejson
+from flask import current_app
+from marshmallow import Schema, fields, missing
+from schemas import (CubeSchema, ExchangeSchema, ExPairSchema, OrderSchema,
+                     TransactionSchema, dump)
+
+
+# Compiled serializers walk a marshmallow schema once and turn every declared
+# field into a plain converter, so dumping a row is a getter call plus a dict
+# build instead of marshmallow's per-field dispatch. Output matches
+# schema.dump() for the field types used in schemas.py; anything not fast
+# pathed here falls back to the marshmallow field itself.
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+def _int(value):
+    return None if value is None else int(value)
+
+
+def _decimal(value):
+    if value is None or type(value) is Decimal:
+        return value
+    return Decimal(str(value))
+
+
+class CompiledSchema(object):
+
+    def __init__(self, schema_class):
+        self.schema_class = schema_class
+        self.keys = []
+        self.attributes = []
+        self.converters = []
+        for name, field in schema_class._declared_fields.items():
+            self.keys.append(name)
+            self.attributes.append(field.attribute or name)
+            self.converters.append(_converter(name, field))
+        self.field_names = tuple(self.keys)
+        self._plan = list(zip(self.keys, self.attributes, self.converters))
+        self._getter = attrgetter(*self.attributes)
+        self._single = len(self.attributes) == 1
+        # Classes whose instances lack some attribute take the slow path
+        self._partial = set()
+
+    def dump(self, obj):
+        if obj is None:
+            return None
+        if type(obj) not in self._partial:
+            try:
+                values = self._getter(obj)
+            except AttributeError:
+                self._partial.add(type(obj))
+            else:
+                return self._emit((values,) if self._single else values)
+        data = {}
+        for key, attribute, convert in self._plan:
+            value = getattr(obj, attribute, missing)
+            if value is not missing:
+                data[key] = convert(value)
+        return data
+
+    def dump_many(self, objs):
+        dump_one = self.dump
+        return [dump_one(obj) for obj in objs]
+
+    def dump_rows(self, rows):
+        # Rows are plain tuples whose columns follow field_names, e.g. the
+        # result of a column query built from this serializer
+        emit = self._emit
+        return [emit(row) for row in rows]
+
+    def _emit(self, values):
+        return {key: convert(value) for key, convert, value
+                in zip(self.keys, self.converters, values)}
+
+
+def _converter(name, field):
+    field_type = type(field)
+    if field_type in (fields.Str, fields.String):
+        return _str
+    if field_type in (fields.Int, fields.Integer) and not field.as_string:
+        return _int
+    if field_type is fields.Decimal and field.places is None and not field.as_string:
+        return _decimal
+    if field_type in (fields.Bool, fields.Boolean):
+        serialize = field._serialize
+        return lambda value: value if value is None or type(value) is bool \
+            else serialize(value, name, None)
+    if field_type is fields.Nested:
+        return _nested_converter(field)
+    if field_type is fields.List:
+        inner = getattr(field, 'inner', None) or field.container
+        if type(inner) is fields.Nested:
+            dump_one = _nested_converter(inner)
+        else:
+            dump_one = _converter(name, inner)
+
+        def convert_list(value):
+            if value is None:
+                return None
+            if isinstance(value, (str, bytes, dict)) or not hasattr(value, '__iter__'):
+                return [dump_one(value)]
+            return [dump_one(each) for each in value]
+        return convert_list
+    serialize = field._serialize
+    return lambda value: serialize(value, name, None)
+
+
+def _nested_converter(field):
+    nested = field.nested
+    many = field.many
+    if isinstance(nested, Schema):
+        many = many or nested.many
+        nested = type(nested)
+    if field.only or field.exclude:
+        schema = nested(many=many, only=field.only, exclude=field.exclude)
+        return lambda value: None if value is None else dump(schema, value)
+    compiled = compile_schema(nested)
+    if many:
+        return lambda value: None if value is None else compiled.dump_many(value)
+    return compiled.dump
+
+
+_compiled = {}
+
+
+def compile_schema(schema_class):
+    if schema_class not in _compiled:
+        _compiled[schema_class] = CompiledSchema(schema_class)
+    return _compiled[schema_class]
+
+
+cube_serializer = compile_schema(CubeSchema)
+exchange_serializer = compile_schema(ExchangeSchema)
+ex_pair_serializer = compile_schema(ExPairSchema)
+order_serializer = compile_schema(OrderSchema)
+transaction_serializer = compile_schema(TransactionSchema)
+
+
+# JSON output. simplejson writes Decimal as a number literal, the same as
+# Flask's jsonify does when simplejson is installed.
+
+def _json_default(o):
+    if isinstance(o, (datetime, date)):
+        return o.isoformat()
+    raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+
+_encoder = simplejson.JSONEncoder(use_decimal=True, default=_json_default,
+                                  separators=(',', ':'))
+
+
+def dumps(data):
+    return _encoder.encode(data)
+
+
+def json_response(data, status=200):
+    return current_app.response_class(dumps(data) + '\n', status=status,
+                                      mimetype='application/json')